@@ -3,36 +3,87 @@
 This script retrieves an RSS feed and posts it to a specified page on the wiki.
 The feed can then be embedded on other wiki pages as needed.
 
+Several feeds can be read in one run, either merged into one page or posted
+to one page each. The feeds are fetched at the same time, with the ETag and
+Last-Modified values from the previous run, so an unchanged feed is not
+downloaded again; a page is only saved when its list of posts changes.
+
 """
 
+import os
+import hashlib
+import calendar
 import pywikibot
 import datetime
 import feedparser
 from email.utils import parsedate
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-def blog_feed(blog_url, max_age):
-    tpl = '===[{link} {title}]===\n{summary}'
+import statefile
+
+# feeds fetched at the same time
+MAX_WORKERS = 8
 
-    start_time = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
-    start_time = start_time.replace(microsecond=0).isoformat()
+# fields of a post kept between runs
+POST_FIELDS = ('link', 'title', 'summary', 'published')
 
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
+def _timestamp(post):
+    parsed = post.get('published_parsed') or post.get('updated_parsed')
+    if parsed:
+        return calendar.timegm(parsed)
+    pub_date = parsedate(post['published']) # Wed, 16 Dec 2020 19:20:03 +0000
+    return time.mktime(pub_date)
 
-    feed = feedparser.parse(blog_url)
-    print(feed.status)
-    posts = feed['entries']
+def fetch_feed(blog_url, saved=None):
+    """Read the feed at `blog_url`, passing back the ETag and Last-Modified
+    values `saved` from the previous run. Return the feed's state: the
+    validators, and the posts newest first. If the feed cannot be read,
+    return `saved`, or None when there is nothing from a previous run.
+    """
+    saved = saved or {}
+    feed = feedparser.parse(blog_url, etag=saved.get('etag', None),
+                            modified=saved.get('modified', None))
+    status = feed.get('status', None)
+    if status == 304:
+        return saved
+    if status is None or status >= 400:
+        pywikibot.error('Could not read {}: {}'.format(blog_url,
+            status or feed.get('bozo_exception', 'no response')))
+        return saved or None
+    posts = []
+    for post in feed['entries']:
+        p = {f: post.get(f, '') for f in POST_FIELDS}
+        p['timestamp'] = _timestamp(post)
+        posts.append(p)
+    posts.sort(key=lambda p: p['timestamp'], reverse=True)
+    return {'etag': feed.get('etag', None),
+            'modified': feed.get('modified', None),
+            'posts': posts}
+
+def blog_feed(posts, max_age):
+    tpl = '===[{link} {title}]===\n{summary}'
+    now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
     out = []
 
     for post in posts:
-        pub_date = parsedate(post['published']) # Wed, 16 Dec 2020 19:20:03 +0000
-        pub_date_ts = datetime.datetime.fromtimestamp(time.mktime(pub_date), tz=datetime.timezone.utc)
-        delta = (now-pub_date_ts).total_seconds()
+        delta = now - post['timestamp']
         if delta > max_age:
             break
         out.append(tpl.format(**post))
     return '\n\n'.join(out)
 
+def _merge(feeds):
+    """Merge the posts of several feeds, newest first, listing a post found
+    in more than one feed once."""
+    posts = sorted((p for f in feeds for p in f.get('posts', [])),
+                   key=lambda p: p['timestamp'], reverse=True)
+    seen = set()
+    for p in posts:
+        if p['link'] not in seen:
+            seen.add(p['link'])
+            yield p
+
 def run(*args):
     local_args = pywikibot.handle_args(args)
     required = ['pagename', 'blog_url']
@@ -46,11 +97,49 @@ def run(*args):
             value = pywikibot.input('Please enter a value for ' + option)
             options[option] = value
 
+    urls = options['blog_url'].split(';')
+    pagenames = options['pagename'].split(';')
+    if len(pagenames) not in (1, len(urls)):
+        pywikibot.error('Give one pagename, or one for each feed')
+        return
+
     max_age = 86400*(int(options.get('days', '45')))
+    state_file = options.get('state', os.path.expanduser(
+        os.path.join('~', 'blog2wiki.json')))
+    state = statefile.load(state_file) or {}
+    state.setdefault('feeds', {})
+    state.setdefault('pages', {})
+
+    with ThreadPoolExecutor(
+            max_workers=min(len(urls), MAX_WORKERS)) as executor:
+        feeds = list(executor.map(
+            lambda url: fetch_feed(url, state['feeds'].get(url, None)), urls))
+    state['feeds'].update((u, f) for (u, f) in zip(urls, feeds) if f)
+
+    if len(pagenames) == 1:
+        groups = [(pagenames[0], urls, feeds)]
+    else:
+        groups = [(p, [u], [f]) for (p, u, f) in zip(pagenames, urls, feeds)]
+
     site = pywikibot.Site()
-    target = pywikibot.Page(site, options['pagename'])
-    target.text = blog_feed(options['blog_url'], max_age) + '\n\n__NOTOC__'
-    target.save('Imported from blog feed at {}'.format(options['blog_url']))
+    for (pagename, group_urls, group_feeds) in groups:
+        if None in group_feeds:
+            # a feed read for the first time failed; keep the page as it is
+            pywikibot.error('Not updating {}: a feed could not be read'.format(
+                pagename))
+            continue
+        text = blog_feed(_merge(group_feeds), max_age) + '\n\n__NOTOC__'
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if state['pages'].get(pagename) == digest:
+            print('No changes to {}'.format(pagename))
+            continue
+        target = pywikibot.Page(site, pagename)
+        target.text = text
+        target.save('Imported from blog feed at {}'.format(
+            ', '.join(group_urls)))
+        state['pages'][pagename] = digest
+
+    statefile.save(state_file, state)
 
 if __name__ == '__main__':
     run()
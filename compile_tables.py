@@ -4,6 +4,18 @@ This pywikibot script reads tables from the pages in a category on the wiki,
 then creates a combined table using fields that are in common to those
 tables.
 
+The pages are read in batches, and their tables are read from the wikitext.
+Only pages whose tables may be built by templates are parsed by the wiki.
+
+The rows read from each page are cached with the page's revision ID, so only
+the pages edited since the last run are read again.
+
+Large tables can be split into subpages of the target page, which then lists
+the subpages; only the subpages whose rows have changed are saved, and
+subpages that are no longer needed are emptied. The rows can also be
+exported as CSV or JSON. Rows are written out as they are read, except with
+-sort, where they are sorted in memory first.
+
 OPTIONS:
 
   -fieldnames:FIELDNAMES (required)
@@ -12,13 +24,41 @@ OPTIONS:
     Target wiki pagename
   -category:CATEGORY (required)
     The wiki category containing the pages with tables.
+  -cache:PATH
+    File in which the rows read from the pages are kept between runs
+    (default: ~/compile_tables_CATEGORY.json)
+  -refresh:true
+    Read all the pages again, e.g., after a template used in the tables
+    was changed.
+  -sort:FIELDNAME
+    Sort the rows by this field (default: category order)
+  -split:N
+    Write the table to subpages of the target page (TARGET/1, TARGET/2,
+    ...) of N rows each, and list the subpages on the target page.
+  -export:PATH
+    Also write the rows to a file, as JSON if PATH ends in '.json',
+    otherwise as CSV.
 
 """
 
+import os
+import re
+import csv
+import json
+import hashlib
+import itertools
+import contextlib
+
+import mwparserfromhell
 import pywikibot
 from pywikibot import pagegenerators
 from bs4 import BeautifulSoup
 
+import statefile
+
+# pages whose wikitext is read in each request
+BATCH_SIZE = 50
+
 def parse_table(html):
     soup = BeautifulSoup(html, 'html.parser')
     data = []
@@ -34,7 +74,163 @@ def parse_table(html):
             data.append((k, v))
     return dict(data)
 
-def run():
+def _rows(table):
+    """Return the cells of each row of a wikitext table. The cells before
+    the first row separator form the first row."""
+    rows = [[]]
+    for node in table.contents.filter_tags(recursive=False):
+        if node.tag == 'tr':
+            rows.append(node.contents.filter_tags(recursive=False))
+        elif node.tag in ('th', 'td'):
+            rows[0].append(node)
+    return rows
+
+def parse_wikitext(text):
+    """Read the key/value rows of the wikitables in `text`, as parse_table
+    does from the HTML. Return None if the page has templates outside its
+    tables, which may add tables of their own, or if the cells are built by
+    templates; both can only be read from the parsed page."""
+    code = mwparserfromhell.parse(text)
+    tables = [t for t in code.filter_tags(matches=lambda n: n.tag == 'table')
+              if t.has('class')
+              and 'wikitable' in str(t.get('class').value).split()]
+    in_tables = {id(n) for t in tables for n in t.contents.filter_templates()}
+    if any(id(n) not in in_tables for n in code.filter_templates()):
+        return None
+    data = []
+    for table in tables:
+        for cells in _rows(table):
+            th = next((c for c in cells if c.tag == 'th'), None)
+            td = next((c for c in cells if c.tag == 'td'), None)
+            if th is None or td is None:
+                continue
+            if th.contents.filter_templates() or td.contents.filter_templates():
+                return None
+            k = th.contents.strip_code().strip()
+            if not k:
+                continue
+            v = ' '.join(td.contents.strip_code().split())
+            k = k.lower()
+            if k == 'title':
+                v = '[[{}]]'.format(v)
+            data.append((k, v))
+    return dict(data)
+
+def read_rows(category, cache):
+    """Yield the rows read from the pages in `category`, in category order,
+    as they are read.
+
+    `cache` maps page titles to [revision ID, row] pairs. The category
+    listing gives the latest revision ID of each page (one request for up to
+    500 pages), so only pages with a different revision are read again.
+    Pages that have left the category are dropped from the cache once all
+    the rows have been read.
+    """
+    members = list(pagegenerators.CategorizedPageGenerator(category))
+    changed = set(p.title() for p in members
+                  if cache.get(p.title(), [None])[0] != p.latest_revision_id)
+    print('{} of {} page(s) changed'.format(len(changed), len(members)))
+    # the changed pages are preloaded in category order
+    preloaded = iter(pagegenerators.PreloadingGenerator(
+            [p for p in members if p.title() in changed],
+            groupsize=BATCH_SIZE))
+    loaded = set()
+
+    for page in members:
+        title = page.title()
+        while title in changed and title not in loaded:
+            p = next(preloaded, None)
+            if p is None: # e.g., deleted since it was listed
+                break
+            data = parse_wikitext(p.text)
+            if data is None:
+                data = parse_table(p.get_parsed_page())
+            cache[p.title()] = [p.latest_revision_id, data]
+            loaded.add(p.title())
+        if title in cache:
+            yield cache[title][1]
+
+    titles = set(p.title() for p in members)
+    for title in set(cache) - titles:
+        del cache[title]
+
+@contextlib.contextmanager
+def export(path, fieldnames):
+    """Yield a function that writes a row to `path`, as JSON if the path
+    ends in '.json' and otherwise as CSV. The file is replaced once all the
+    rows have been written."""
+    if not path:
+        yield lambda data: None
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as fd:
+        if path.endswith('.json'):
+            sep = ['[\n']
+            def write(data):
+                fd.write(sep[0] + json.dumps(
+                    {f: data.get(f, '') for f in fieldnames}))
+                sep[0] = ',\n'
+            yield write
+            fd.write('[]\n' if sep[0] == '[\n' else '\n]\n')
+        else:
+            writer = csv.DictWriter(fd, fieldnames, restval='',
+                                    extrasaction='ignore')
+            writer.writeheader()
+            yield writer.writerow
+    os.replace(tmp, path)
+
+def _table(records, fieldnames, write):
+    rows = []
+    rows.append('{| class="wikitable sortable"')
+    rows.append('! ' + ' !! '.join(fieldnames))
+
+    for data in records:
+        write(data)
+        rows.append('|-')
+        rows.append('| ' + ' || '.join([data.get(f, '') for f in fieldnames]))
+
+    rows.append('|}')
+    return '\n'.join(rows)
+
+def _label(value):
+    return ' '.join(mwparserfromhell.parse(value).strip_code().split())
+
+def tables(records, fieldnames, size, write, sort=None):
+    """Yield the subpage number, text and index label of each table of
+    `size` rows, passing each row to `write` as it is added. Only one table
+    of rows is held at a time."""
+    records = iter(records)
+    n = 0
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        if sort:
+            label = '{} – {}'.format(_label(chunk[0].get(sort, '')),
+                                     _label(chunk[-1].get(sort, '')))
+        else:
+            label = 'rows {}–{}'.format(n + 1, n + len(chunk))
+        yield n // size + 1, _table(chunk, fieldnames, write), label
+        n += len(chunk)
+
+def _listed_subpages(site, target):
+    """Return the subpages linked from the index page `target`."""
+    page = pywikibot.Page(site, target)
+    if not page.exists():
+        return set()
+    return set(re.findall(r'\[\[({}/\d+)[|\]]'.format(re.escape(target)),
+                          page.text))
+
+def _save(site, pagename, text, summary):
+    """Save `text` to `pagename` unless the page already has that text."""
+    target = pywikibot.Page(site, pagename)
+    if target.exists() and target.text.strip() == text.strip():
+        print('No changes to {}'.format(pagename))
+        return
+    target.text = text
+    target.save(summary)
+
+def run(*args):
     local_args = pywikibot.handle_args(args)
     required = ['fieldnames', 'category', 'target']
     options = {}
@@ -49,25 +245,48 @@ def run():
 
     site = pywikibot.Site()
     category = pywikibot.Category(site, options['category'])
-    pages = pagegenerators.CategorizedPageGenerator(category)
-    rows = []
-    rows.append('{| class="wikitable sortable"')
-    fieldnames = [f.strip() for f in options['fieldnames'].split(';')]
-    rows.append('! ' + ' !! '.join(fieldnames))
-
-    for page in pages:
-        html=page.get_parsed_page()
-        data = parse_table(html)
-        rows.append('|-')
-        rows.append('| ' + ' || '.join([data[f] or '' for f in fieldnames]))
+    cache_file = options.get('cache', os.path.expanduser(os.path.join('~',
+        'compile_tables_{}.json'.format(re.sub(r'\W+', '_',
+                                               options['category'])))))
+    state = {} if options.get('refresh') else statefile.load(cache_file) or {}
+    cache = state.setdefault('pages', {})
+    records = read_rows(category, cache)
 
-    rows.append('|}')
-    wikitext = '\r\n'.join(rows)
+    fieldnames = [f.strip() for f in options['fieldnames'].split(';')]
+    sort = options.get('sort', None)
+    if sort:
+        records = sorted(records,
+                key=lambda data: _label(data.get(sort, '')).lower())
+    summary = 'Updated table based on contents of {}'.format(
+            options['category'])
+    target = options['target']
 
-    target = pywikibot.Page(site, options['target'])
-    target.text = wikitext
-    target.save('Updated table based on contents of {}'.format(
-            options['category']))
+    try:
+        with export(options.get('export', None), fieldnames) as write:
+            saved = state.get('subpages', {})
+            listed = _listed_subpages(site, target) | set(saved)
+            state['subpages'] = {}
+            if not options.get('split', None):
+                _save(site, target, _table(records, fieldnames, write), summary)
+            else:
+                # subpages are saved as they are made, when their rows changed
+                index = []
+                for (n, text, label) in tables(records, fieldnames,
+                        int(options['split']), write, sort):
+                    subpage = '{}/{}'.format(target, n)
+                    index.append('* [[{}|{}]]'.format(subpage, label))
+                    digest = hashlib.sha1(text.encode()).hexdigest()
+                    if saved.get(subpage) != digest:
+                        _save(site, subpage, text, summary)
+                    state['subpages'][subpage] = digest
+                _save(site, target, '\n'.join(index), summary)
+            # e.g., the table has fewer rows than before
+            for subpage in sorted(listed - set(state['subpages'])):
+                print('Emptying {}, which is no longer used'.format(subpage))
+                _save(site, subpage, '', summary)
+    finally:
+        # the rows read are kept even if a save fails
+        statefile.save(cache_file, state)
 
 if __name__ == '__main__':
     run()
@@ -45,23 +45,45 @@ OPTIONS:
         Text to insert at the top of the page
   -limit:LIMIT
         Number of pages to return.
+  -days:DAYS
+        Only list pages created within this past number of days.
 """
 
 import sys
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from pyzotero import zotero
 import pypandoc
 import pywikibot
 
-def html2wiki(input):
-    w = pypandoc.convert_text(input, 'mediawiki', format='html').strip()
+# TextExtracts returns intro extracts for at most 20 pages per request
+EXTRACTS_BATCH = 20
+
+# requests run at the same time
+MAX_WORKERS = 4
+
+def html2wiki(input, memo=None):
+    convert = memo.convert_text if memo else pypandoc.convert_text
+    w = convert(input, 'mediawiki', format='html').strip()
     w = ' '.join(w.split()) #conflate whitespaces
     w = w.replace('<div', '<span').replace('</div>', '</span>')
     return w
 
-def featured(category='', limit=None, **kwargs):
+def _extracts(site, titles):
+    return list(pywikibot.data.api.PropertyGenerator(
+            site=site,
+            prop='extracts|info',
+            titles=titles,
+            exsentences=5,
+            exintro=1,
+            exlimit=EXTRACTS_BATCH,
+            exsectionformat='plain',
+            explaintext=1,
+            inprop='url'))
+
+def featured(category='', limit=None, days=None, **kwargs):
     site = pywikibot.Site()
     tpl = "===[{canonicalurl} {title}]===\n{extract}"
     cat = pywikibot.page.Category(site, category)
@@ -69,22 +91,36 @@ def featured(category='', limit=None, **kwargs):
         limit = int(limit)
     else:
         limit = 30
-    pages = cat.newest_pages(total=limit) # gives recent edits, not creation
-    out = []
-    titles = [page.title() for page in pages]
 
-    extracts = pywikibot.data.api.PropertyGenerator(
-            site=site,
-            prop='extracts|info',
-            titles=titles,
-            exsentences=5,
-            exintro=1,
-            exsectionformat='plain',
-            explaintext=1,
-            inprop='url')
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        if days:
+            # a page created after the cutoff was also added to the
+            # category after it
+            cutoff = pywikibot.Timestamp.utcnow() - datetime.timedelta(
+                    days=int(days))
+            pages = list(cat.members(member_type='page', sortby='timestamp',
+                                     reverse=True, starttime=cutoff))
+            created = executor.map(
+                    lambda page: page.oldest_revision.timestamp, pages)
+            pages = [page for (page, t) in zip(pages, created)
+                     if t >= cutoff][:limit]
+        else:
+            # most recently added to the category first
+            pages = list(cat.members(member_type='page', sortby='timestamp',
+                                     reverse=True, total=limit))
+
+        titles = [page.title() for page in pages]
+        batches = [titles[i:i+EXTRACTS_BATCH]
+                   for i in range(0, len(titles), EXTRACTS_BATCH)]
+        extracts = {e['title']: e
+                    for batch in executor.map(lambda b: _extracts(site, b),
+                                              batches)
+                    for e in batch}
 
-    for e in extracts:
-        out.append(tpl.format(**e))
+    out = []
+    for title in titles:
+        if title in extracts:
+            out.append(tpl.format(**extracts[title]))
 
     return '\n'.join(out)
 
@@ -110,7 +146,9 @@ def run(*args):
     if 'preface' in options:
         mw = '\n\n'.join([options['preface'], mw])
     target = pywikibot.Page(site, options['pagename'])
-
+    if target.exists() and target.text == mw:
+        print('No changes to {}'.format(options['pagename']))
+        return
     target.text = mw
     target.save('Updated by featuredpages bot')
 
@@ -19,60 +19,324 @@
 Script to read an iCalendar file, accessible from a public URL, and update a
 wiki page containing a listing of upcoming events from the calendar file.
 
+The calendar is fetched with a conditional request, so an unchanged file is
+not downloaded again, and the page rendered from it is reused until the
+window of upcoming events moves on.
+
+Recurring events (RRULE, RDATE and EXDATE, with instances changed through
+RECURRENCE-ID) are listed once for each occurrence in the window.
+
+Several calendars can be read at once. Their events are merged into one
+listing, in which an event found in more than one calendar is only listed
+once, or written to one page per calendar.
+
 OPTIONS:
 
   -calendar:CALENDAR (required)
-        URL of the input iCalendar file
+        URL of the input iCalendar file, or several URLs separated by
+        semicolons
   -pagename:PAGENAME (required)
-        Target wiki pagename
+        Target wiki pagename. With several calendars, give one pagename
+        per calendar (separated by semicolons) to write each calendar to
+        its own page, or a single pagename for a combined listing.
+  -days:N
+        Only list the events in the next N days (default: all upcoming
+        events, with recurring events repeated over the next 365 days)
+  -cache:PATH
+        Cache for the calendar file, the rendered page and the pandoc
+        conversions of event texts (default: ~/.ical2wiki_cache.sqlite)
+  -cache_size:MB
+        Maximum size of the cache (default: 100)
+  -stats:true
+        Print the hit rate of the pandoc conversion cache
 """
 
+import bisect
+import hashlib
+import heapq
+import json
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import dateutil.parser
-from datetime import datetime, date
+from dateutil.rrule import rruleset, rrulestr
+from datetime import datetime, date, time, timedelta
 import urllib.parse
 
 from icalendar import Calendar, __version__
 import pypandoc
 import pywikibot
 
-def html2wiki(input):
-    w = pypandoc.convert_text(input, 'plain', format='html').strip()
+import lrucache
+import pandoccache
+
+DEFAULT_CACHE = os.path.expanduser(os.path.join('~', '.ical2wiki_cache.sqlite'))
+
+TEMPLATE = "=== {time}. {summary}===\n{description}"
+
+# days over which recurring events are repeated when the window is open-ended
+RECURRENCE_DAYS = 365
+
+# calendars fetched at the same time
+MAX_WORKERS = 8
+
+# length of a period of the rules that can be moved forward by whole periods
+PERIODS = {'DAILY': timedelta(days=1), 'WEEKLY': timedelta(weeks=1)}
+
+def html2wiki(input, memo=None):
+    convert = memo.convert_text if memo else pypandoc.convert_text
+    w = convert(input, 'plain', format='html').strip()
     w = ' '.join(w.split()) #conflate whitespaces
     return w
 
-def get_calendar(calendar=None, **kwargs):
-    """Read an iCalendar file from the URL at `calendar`.
-    Return formatted wikitext version of the events listing.
+def _as_datetime(dt):
+    """Return a date or datetime as a naive datetime in local time, so that
+    all-day and timed events can be sorted together."""
+    if not isinstance(dt, datetime):
+        return datetime.combine(dt, time())
+    if dt.tzinfo is not None:
+        return dt.astimezone().replace(tzinfo=None)
+    return dt
+
+def _end(event, start):
+    if event.get('dtend'):
+        return _as_datetime(event.get('dtend').dt)
+    if event.get('duration'):
+        return start + event.get('duration').dt
+    return start
+
+def _like(dt, ref):
+    """Return a date or datetime from a recurrence property as a datetime
+    comparable with the series' first occurrence `ref`."""
+    if isinstance(dt, tuple): # a PERIOD
+        dt = dt[0]
+    if not isinstance(dt, datetime):
+        dt = datetime.combine(dt, time())
+    if ref.tzinfo is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=ref.tzinfo)
+    if ref.tzinfo is None and dt.tzinfo is not None:
+        return _as_datetime(dt)
+    return dt
+
+def _rule_start(rule, first, after):
+    """Return the start from which to expand `rule`: when the rule is not
+    counted, daily and weekly series are moved forward by whole periods to
+    just before the window, rather than being stepped through from their
+    first occurrence."""
+    freq = rule.get('FREQ', [None])[0]
+    if freq not in PERIODS or 'COUNT' in rule:
+        return first
+    period = PERIODS[freq] * int(rule.get('INTERVAL', [1])[0])
+    periods = (after.replace(tzinfo=None) - first.replace(tzinfo=None)) // period
+    if periods < 2:
+        return first
+    return first + (periods - 1) * period
+
+def _dates(prop):
+    """Return the dates in an RDATE or EXDATE property, which icalendar
+    gives as a list when the property is repeated."""
+    if prop is None:
+        return []
+    if not isinstance(prop, list):
+        prop = [prop]
+    return [d.dt for p in prop for d in p.dts]
+
+def fetch_calendar(url, cache=None):
+    """Read the iCalendar file at `url`, revalidating the cached copy with a
+    conditional request. Return the file and a digest of its content."""
+    cached = cache.get(url) if cache else None
+    headers = {}
+    if cached:
+        body, meta, age = cached
+        if meta.get('ETag'):
+            headers['If-None-Match'] = meta['ETag']
+        if meta.get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['Last-Modified']
+    r = requests.request('GET', url, headers=headers)
+    if r.status_code == 304 and cached:
+        cache.refresh(url)
+        return body, meta['digest']
+    r.raise_for_status()
+    digest = hashlib.sha1(r.content).hexdigest()
+    if cache:
+        meta = {h: r.headers[h] for h in ('ETag', 'Last-Modified')
+                if h in r.headers}
+        meta['digest'] = digest
+        cache.set(url, r.content, meta)
+    return r.content, digest
+
+class EventIndex:
+    """The events of a calendar, sorted by start time.
+
+    Recurring events are kept apart, and only expanded over the window that
+    is asked for.
     """
 
-    if not calendar:
-        return ''
-    tpl = "=== {time}. {summary}===\n{description}"
-    r = requests.request('GET', calendar)
-    cal = Calendar.from_ical(r.text)
-    out = []
+    def __init__(self, events):
+        single = []
+        self.series = []
+        self.overrides = set()
+        for e in events:
+            if not e.get('dtstart'):
+                continue
+            if e.get('recurrence-id'):
+                # a changed instance replaces an occurrence of its series
+                self.overrides.add((str(e.get('uid', '')),
+                    _as_datetime(e.get('recurrence-id').dt)))
+                single.append(e)
+            elif e.get('rrule') or e.get('rdate'):
+                self.series.append(e)
+            else:
+                single.append(e)
+        self.events = sorted(
+            ((_as_datetime(e.get('dtstart').dt), n, e)
+             for (n, e) in enumerate(single)),
+            key=lambda x: x[:2])
+        self.starts = [x[0] for x in self.events]
+        self.longest = max((_end(e, start) - start
+                            for (start, n, e) in self.events),
+                           default=timedelta(0))
 
-    events = {datetime.strftime(event.get('dtstart').dt, "%Y-%m-%d"):
-                event for event in cal.walk('vevent')}
+    def _single(self, start, end=None):
+        # events that started before the window can only overlap it if
+        # they are shorter than the longest event
+        i = bisect.bisect_left(self.starts, start - self.longest)
+        j = (bisect.bisect_left(self.starts, end) if end
+             else len(self.starts))
+        for (dtstart, n, event) in self.events[i:j]:
+            if _end(event, dtstart) >= start:
+                yield dtstart, event
 
-    for t, event in sorted(events.items()):
-        end = str(event.get('dtend').dt)
-        today = str(date.today())
-        if end < today:
-            continue
-        time = datetime.strftime(event.get('dtstart').dt, '%Y-%m-%d')
+    def _occurrences(self, event, start, end):
+        """Yield the occurrences of a recurring event in the window, lazily
+        and in order."""
+        dtstart = event.get('dtstart').dt
+        first = dtstart
+        if not isinstance(first, datetime):
+            first = datetime.combine(first, time())
+        duration = _end(event, _as_datetime(first)) - _as_datetime(first)
+        uid = str(event.get('uid', ''))
+        after = start - duration
+        if first.tzinfo is not None:
+            after = after.astimezone(first.tzinfo)
+        rules = rruleset()
+        rules.rdate(first)
+        try:
+            rrule = event.get('rrule')
+            for rule in (rrule if isinstance(rrule, list) else [rrule]):
+                if rule:
+                    rules.rrule(rrulestr(rule.to_ical().decode(),
+                        dtstart=_rule_start(rule, first, after)))
+            for dt in _dates(event.get('rdate')):
+                rules.rdate(_like(dt, first))
+            for dt in _dates(event.get('exdate')):
+                rules.exdate(_like(dt, first))
+        except ValueError as err:
+            pywikibot.warning('Ignoring the recurrence of {}: {}'.format(
+                event.get('summary', uid), err))
+            rules = rruleset()
+            rules.rdate(first)
+
+        for occurrence in rules.xafter(after, inc=True):
+            occurrence = _as_datetime(occurrence)
+            if occurrence >= end:
+                break
+            if (uid, occurrence) in self.overrides:
+                continue
+            if occurrence + duration >= start:
+                yield occurrence, event
+
+    def window(self, start, end=None):
+        """Return an iterator over the (start, event) pairs of the events that
+        are not over by `start` and begin before `end`, in order of start."""
+        horizon = end or start + timedelta(days=RECURRENCE_DAYS)
+        streams = [self._single(start, end)]
+        streams += [self._occurrences(e, start, horizon) for e in self.series]
+        return heapq.merge(*streams, key=lambda x: x[0])
 
+def _dedup(events):
+    """Drop the events already seen in another calendar, identified by
+    their UID and the instance (RECURRENCE-ID, or start) they stand for."""
+    seen = set()
+    for (start, event) in events:
+        uid = event.get('uid', None)
+        if uid is not None:
+            instance = event.get('recurrence-id', None)
+            instance = _as_datetime(instance.dt) if instance else start
+            if (str(uid), instance) in seen:
+                continue
+            seen.add((str(uid), instance))
+        yield start, event
+
+def render(events, tpl=TEMPLATE, memo=None):
+    out = []
+    for (start, event) in events:
         summary = event.get('summary', ' ')
         description = event.get('description', ' ')
-
         out.append( tpl.format(
-            summary=html2wiki(summary),
-            time=time,
-            description=html2wiki(description) ) )
+            summary=html2wiki(summary, memo),
+            time=datetime.strftime(start, '%Y-%m-%d'),
+            description=html2wiki(description, memo) ) )
     return '\n\n'.join(out)
 
+def get_calendars(urls, combined=True, days=None, cache=DEFAULT_CACHE,
+        cache_size=100, stats=None, **kwargs):
+    """Read the iCalendar files at `urls`, fetched concurrently.
+    Return formatted wikitext versions of the events listing: a single one
+    for all the files if `combined`, or else one for each file.
+    """
+
+    store = None
+    if cache:
+        store = lrucache.LRUCache(cache,
+            max_size=int(cache_size) * lrucache.MB)
+    memo = pandoccache.PandocCache(store)
+    start = datetime.combine(date.today(), time())
+    end = start + timedelta(days=int(days)) if days else None
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=min(len(urls), MAX_WORKERS)) as executor:
+            files = list(executor.map(
+                lambda url: fetch_calendar(url, store), urls))
+        groups = [files] if combined else [[f] for f in files]
+
+        out = []
+        for group in groups:
+            # the page only changes with the files or with the window
+            key = 'page:' + hashlib.sha1(json.dumps(
+                [[digest for (body, digest) in group], str(start), str(end),
+                 TEMPLATE]).encode()).hexdigest()
+            cached = store.get(key) if store else None
+            if cached:
+                out.append(cached[0].decode())
+                continue
+            indexes = [EventIndex(Calendar.from_ical(body).walk('vevent'))
+                       for (body, digest) in group]
+            events = heapq.merge(*[i.window(start, end) for i in indexes],
+                                 key=lambda x: x[0])
+            mw = render(_dedup(events), memo=memo)
+            if store:
+                store.set(key, mw.encode())
+            out.append(mw)
+        if stats:
+            print(memo.summary())
+        return out
+    finally:
+        if store:
+            store.close()
+
+def get_calendar(calendar=None, **kwargs):
+    """Read an iCalendar file from the URL at `calendar` (or several,
+    separated by semicolons).
+    Return formatted wikitext version of the events listing.
+    """
+
+    if not calendar:
+        return ''
+    return get_calendars(calendar.split(';'), **kwargs)[0]
+
 def run(*args):
     options = {}
     local_args = pywikibot.handle_args(args)
@@ -89,13 +353,22 @@ def run(*args):
             value = pywikibot.input('Please enter a value for ' + option)
             options[option] = value
 
+    urls = options.pop('calendar').split(';')
+    pagenames = options.pop('pagename').split(';')
+    if len(pagenames) not in (1, len(urls)):
+        sys.exit('Give one pagename, or one for each calendar')
+
     site = pywikibot.Site()
-    mw = get_calendar(**options)
-    if 'preface' in options:
-        mw = '\n\n'.join([options['preface'], mw])
-    target = pywikibot.Page(site, options['pagename'])
-    target.text = mw
-    target.save('Updated from iCal file')
+    listings = get_calendars(urls, combined=len(pagenames) == 1, **options)
+    for (pagename, mw) in zip(pagenames, listings):
+        if 'preface' in options:
+            mw = '\n\n'.join([options['preface'], mw])
+        target = pywikibot.Page(site, pagename)
+        if target.exists() and target.text == mw:
+            print('No changes to {}'.format(pagename))
+            continue
+        target.text = mw
+        target.save('Updated from iCal file')
 
 if __name__ == '__main__':
     run()
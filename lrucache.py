@@ -0,0 +1,110 @@
+# Copyright 2022 Eric Thrift
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""lrucache
+
+Size-bounded on-disk cache, shared by the scripts. Entries are kept in an
+SQLite file and the least recently used entries are dropped once the cache
+grows past its maximum size. SQLite's locking makes it safe for several
+scripts (e.g., cron jobs) to use the same cache file at once.
+
+This is a helper module, not a script.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+MB = 1024 * 1024
+
+
+class LRUCache:
+    """Key/value store in the SQLite file at `path`, at most `max_size`
+    bytes of values."""
+
+    def __init__(self, path, max_size=100 * MB):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            value BLOB,
+            meta TEXT,
+            size INTEGER,
+            stored REAL,
+            used REAL)""")
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.db.commit()
+
+    def get(self, key):
+        """Return (value, meta, age in seconds) for `key`, or None."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT value, meta, stored FROM entries WHERE key = ?',
+                (key,)).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            self.db.execute('UPDATE entries SET used = ? WHERE key = ?',
+                (now, key))
+            self.db.commit()
+        value, meta, stored = row
+        return value, json.loads(meta), now - stored
+
+    def set(self, key, value, meta=None):
+        """Store `value` (bytes or str) and a json-serializable `meta`."""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (key, value, json.dumps(meta or {}), len(value), now, now))
+            self._evict()
+            self.db.commit()
+
+    def refresh(self, key):
+        """Mark `key` as just stored, e.g., after it has been revalidated."""
+        with self.lock:
+            self.db.execute('UPDATE entries SET stored = ? WHERE key = ?',
+                (time.time(), key))
+            self.db.commit()
+
+    def _evict(self):
+        (total,) = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_size:
+            return
+        rows = self.db.execute('SELECT key, size FROM entries ORDER BY used')
+        drop = []
+        for (key, size) in rows:
+            if total <= self.max_size:
+                break
+            drop.append((key,))
+            total -= size
+        self.db.executemany('DELETE FROM entries WHERE key = ?', drop)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,72 @@
+# Copyright 2022 Eric Thrift
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""pandoccache
+
+Memo cache for pandoc conversions, shared by the scripts. Conversions are
+kept in an lrucache store, keyed by a hash of the input text, the input and
+output formats and the pandoc version, so text that has been converted
+before is looked up rather than passed to a new pandoc process.
+
+This is a helper module, not a script.
+"""
+
+import hashlib
+import json
+
+import pypandoc
+
+
+class PandocCache:
+    """Conversions kept in the LRUCache `store` (no caching if None)."""
+
+    def __init__(self, store=None):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+
+    @property
+    def version(self):
+        # only run pandoc for its version once a conversion is looked up
+        if self._version is None:
+            self._version = pypandoc.get_pandoc_version()
+        return self._version
+
+    def convert_text(self, source, to, format):
+        """Return `source` converted from `format` to `to`, as
+        pypandoc.convert_text would."""
+        if self.store is None:
+            return pypandoc.convert_text(source, to, format=format)
+        key = 'pandoc:' + hashlib.sha256(json.dumps(
+            [self.version, format, to, str(source)]).encode()).hexdigest()
+        cached = self.store.get(key)
+        if cached:
+            self.hits += 1
+            return cached[0].decode()
+        self.misses += 1
+        w = pypandoc.convert_text(source, to, format=format)
+        self.store.set(key, w.encode())
+        return w
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """Return a one-line summary of the counters."""
+        return 'pandoc cache: {} hit(s), {} miss(es) ({:.0%} hit rate)'.format(
+            self.hits, self.misses, self.hit_rate())
@@ -0,0 +1,43 @@
+# Copyright 2022 Eric Thrift
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""statefile
+
+State kept by the scripts between runs (sync cursors, cached rows, page
+digests), as a JSON file. The file is written to a temporary file first and
+moved into place, so an interrupted run does not leave it half written.
+
+This is a helper module, not a script.
+"""
+
+import json
+import os
+
+
+def load(path):
+    """Return the state saved in `path`, or None if there is none yet."""
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return None
+
+
+def save(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(state, fd)
+    os.replace(tmp, path)
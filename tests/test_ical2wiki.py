@@ -0,0 +1,146 @@
+"""Checks of the recurring-event expansion in ical2wiki.
+
+_rule_start moves uncounted daily and weekly series forward to just before
+the window; the occurrences found must be the same as when each series is
+expanded from its first occurrence. The benchmark expands a calendar of
+hundreds of long-running series.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icalendar import Calendar
+
+import ical2wiki
+
+CALENDAR = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//tests//ical2wiki//EN
+BEGIN:VEVENT
+UID:daily-interval
+SUMMARY:Every third day
+DTSTART:20150102T090000
+DTEND:20150102T100000
+RRULE:FREQ=DAILY;INTERVAL=3
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly-byday
+SUMMARY:Every other Monday, Wednesday and Friday
+DTSTART:20160104T180000
+DURATION:PT2H
+RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE,FR
+EXDATE:20240304T180000,20240415T180000
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly-byday
+SUMMARY:Moved instance
+RECURRENCE-ID:20240318T180000
+DTSTART:20240319T190000
+DURATION:PT2H
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly-tz
+SUMMARY:Across daylight saving time
+DTSTART;TZID=America/Toronto:20181007T233000
+DURATION:PT1H
+RRULE:FREQ=WEEKLY;BYDAY=SU
+END:VEVENT
+BEGIN:VEVENT
+UID:daily-allday
+SUMMARY:All-day, every fifth day
+DTSTART;VALUE=DATE:20170301
+RRULE:FREQ=DAILY;INTERVAL=5;UNTIL=20240501
+EXDATE;VALUE=DATE:20240320
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly-counted
+SUMMARY:Counted
+DTSTART:20230102T120000
+RRULE:FREQ=WEEKLY;COUNT=70
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def occurrences(index, start, end):
+    return [(dt, str(e['uid']), str(e['summary']))
+            for (dt, e) in index.window(start, end)]
+
+
+class RuleStartTest(unittest.TestCase):
+
+    def setUp(self):
+        events = Calendar.from_ical(CALENDAR).walk('vevent')
+        self.index = ical2wiki.EventIndex(events)
+
+    def check(self, start, end):
+        found = occurrences(self.index, start, end)
+        with mock.patch.dict(ical2wiki.PERIODS, clear=True):
+            expected = occurrences(self.index, start, end)
+        self.assertTrue(expected)
+        self.assertEqual(found, expected)
+        return found
+
+    def test_matches_full_expansion(self):
+        found = self.check(datetime(2024, 3, 1), datetime(2024, 6, 1))
+        uids = {uid for (dt, uid, summary) in found}
+        self.assertEqual(uids, {'daily-interval', 'weekly-byday', 'weekly-tz',
+                                'daily-allday', 'weekly-counted'})
+        # the exdates and the overridden instance are left out
+        starts = {(dt, uid) for (dt, uid, summary) in found}
+        for dt in (datetime(2024, 3, 4, 18), datetime(2024, 4, 15, 18),
+                   datetime(2024, 3, 18, 18)):
+            self.assertNotIn((dt, 'weekly-byday'), starts)
+        self.assertIn((datetime(2024, 3, 19, 19), 'weekly-byday'), starts)
+        self.assertNotIn((datetime(2024, 3, 20), 'daily-allday'), starts)
+
+    def test_windows(self):
+        # windows starting on every day of a few weeks, so that the jump
+        # lands on every offset within a period
+        for days in range(0, 45):
+            start = datetime(2024, 2, 20) + timedelta(days=days, hours=19)
+            self.check(start, start + timedelta(days=10))
+
+    def test_window_at_first_occurrence(self):
+        self.check(datetime(2015, 1, 2), datetime(2015, 2, 1))
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    SERIES = 500
+
+    def test_many_series(self):
+        lines = ['BEGIN:VCALENDAR', 'VERSION:2.0',
+                 'PRODID:-//tests//ical2wiki//EN']
+        for n in range(self.SERIES):
+            first = date(2000, 1, 1) + timedelta(days=n)
+            rule = ('FREQ=DAILY;INTERVAL={}'.format(n % 7 + 1) if n % 2
+                    else 'FREQ=WEEKLY;BYDAY=MO,TH')
+            lines += ['BEGIN:VEVENT', 'UID:series-{}'.format(n),
+                      'SUMMARY:Series {}'.format(n),
+                      'DTSTART:{:%Y%m%d}T100000'.format(first),
+                      'DURATION:PT1H', 'RRULE:' + rule, 'END:VEVENT']
+        lines.append('END:VCALENDAR')
+        events = Calendar.from_ical('\r\n'.join(lines)).walk('vevent')
+
+        started = time.perf_counter()
+        index = ical2wiki.EventIndex(events)
+        start = datetime(2024, 1, 1)
+        found = list(index.window(start, start + timedelta(days=30)))
+        elapsed = time.perf_counter() - started
+
+        self.assertGreater(len(found), self.SERIES)
+        self.assertLess(elapsed, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
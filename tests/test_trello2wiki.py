@@ -0,0 +1,106 @@
+"""Golden checks for the trello2wiki table renderer.
+
+The expected tables are the output of the pandoc-based renderer that
+_render_table replaced, for the same cards, except where the old output was
+broken on the wiki:
+
+- pandoc gave the table a duplicate class attribute and an empty first row
+  separator;
+- a list at the start of a cell must start on its own line to be rendered
+  as a list;
+- a '|' in a cell must be escaped, or it is read as the attribute separator.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown
+
+import trello2wiki
+
+
+def card(id, name, desc, comments, due='--'):
+    """Return the row data for a card, as _render_card makes it."""
+    return {'id': id, 'name': name, 'description': markdown.markdown(desc),
+            'comments': '<HR>'.join(markdown.markdown(c) for c in comments),
+            'due': due}
+
+
+CARDS = [
+    card('c1', 'Plan the **launch**',
+         'Some **bold** and *italic* text.\n\n'
+         'Second paragraph with a [link](https://example.org).',
+         ['A comment with __strong__ text.'], '2022-05-01'),
+    card('c2', 'Budget',
+         '* one\n* two with **bold**\n\n1. first\n2. second',
+         ['Plain comment', 'Another *one*']),
+    card('c3', 'Review', 'Use `code` here.', []),
+]
+
+EXPECTED = """{| class="wikitable sortable"
+! Name
+! Description
+! Comments
+! Due
+|- style="vertical-align: top;"
+| [https://trello.com/c/c1 Plan the **launch**]
+| Some '''bold''' and ''italic'' text.
+
+Second paragraph with a [https://example.org link].
+| A comment with '''strong''' text.
+| 2022-05-01
+|- style="vertical-align: top;"
+| [https://trello.com/c/c2 Budget]
+|
+* one
+* two with '''bold'''
+* first
+* second
+| Plain comment
+
+-----
+
+Another ''one''
+| --
+|- style="vertical-align: top;"
+| [https://trello.com/c/c3 Review]
+| Use <code>code</code> here.
+|
+| --
+|}"""
+
+PIPES = [
+    card('c4', 'Design | build',
+         'A cell with a | pipe and a <b>tag</b>?', ['**Done**']),
+]
+
+EXPECTED_PIPES = """{| class="wikitable sortable"
+! Name
+! Description
+! Comments
+! Due
+|- style="vertical-align: top;"
+| [https://trello.com/c/c4 Design &#124; build]
+| A cell with a &#124; pipe and a '''tag'''?
+| '''Done'''
+| --
+|}"""
+
+
+class RenderTableTest(unittest.TestCase):
+
+    def test_matches_pandoc(self):
+        self.assertEqual(trello2wiki._render_table(CARDS), EXPECTED)
+
+    def test_pipes_are_escaped(self):
+        self.assertEqual(trello2wiki._render_table(PIPES), EXPECTED_PIPES)
+
+
+if __name__ == '__main__':
+    unittest.main()
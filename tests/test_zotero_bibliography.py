@@ -0,0 +1,52 @@
+"""Checks that the batched pandoc conversion of zotero_bibliography gives the
+same wikitext as converting the entries one at a time.
+
+Needs pypandoc and the pandoc executable.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zotero_bibliography
+
+
+def entry(text):
+    """Return a bibliography entry as Zotero's html format gives it."""
+    return ('<div class="csl-bib-body"><div class="csl-entry">{}</div>'
+            '</div>'.format(text))
+
+
+ENTRIES = [entry(e) for e in [
+    'Smith, J. (2020). <i>A title</i>: a subtitle.',
+    '* Starred, A. (2019). Notes.',
+    '# Hashed, B. (2018). <b>Bold</b> words.',
+    '; Semicolon, C. (2017). Report.',
+    ': Colon, D. (2016). Essay.',
+    '*<i>Italic</i> after a star.',
+    r'\* A literal backslash.',
+    'Jones, K. (2021). A | pipe and a [bracket].',
+]]
+
+
+class Html2WikiBatchTest(unittest.TestCase):
+
+    def test_matches_single_entries(self):
+        single = [zotero_bibliography._html2wiki(e) for e in ENTRIES]
+        self.assertEqual(zotero_bibliography._html2wiki_batch(ENTRIES),
+                         single)
+
+    def test_chunks(self):
+        single = [zotero_bibliography._html2wiki(e) for e in ENTRIES]
+        self.assertEqual(
+            zotero_bibliography._html2wiki_batch(ENTRIES, chunk_size=3),
+            single)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Checks that zotero_recently_added stops requesting pages of a large
+collection once it has passed the items added in the last -days.
+
+The Zotero API is replaced by a fixture that serves a listing of 10,000
+items, newest first, and counts the requests made.
+
+Run with: python -m unittest discover tests
+"""
+
+import datetime
+import os
+import sys
+import unittest
+import urllib.parse
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zoteroapi
+import zotero_recently_added
+
+TOTAL = 10000
+LIMIT = 100
+
+
+class Response:
+
+    def __init__(self, items, start, url):
+        self.status_code = 200
+        self.headers = {'Total-Results': str(TOTAL)}
+        self.links = {}
+        if start + LIMIT < TOTAL:
+            query = urllib.parse.urlencode({'limit': LIMIT,
+                                            'start': start + LIMIT})
+            self.links['next'] = {'url': '{}?{}'.format(url, query)}
+        self._items = items
+
+    def json(self):
+        return self._items
+
+    def raise_for_status(self):
+        pass
+
+
+class Listing:
+    """Stands in for the requests session, serving one item per hour added,
+    newest first."""
+
+    def __init__(self):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.items = [
+            {'key': 'K{:05d}'.format(n), 'meta': {},
+             'data': {'itemType': 'book', 'dateAdded': (
+                 now - datetime.timedelta(hours=n + 0.5)
+             ).strftime('%Y-%m-%dT%H:%M:%SZ')}}
+            for n in range(TOTAL)]
+        self.requests = 0
+
+    def get(self, url, params=None, headers=None):
+        self.requests += 1
+        url, _, query = url.partition('?')
+        params = dict(params or {}, **dict(urllib.parse.parse_qsl(query)))
+        start = int(params.get('start', 0))
+        limit = int(params.get('limit', LIMIT))
+        return Response(self.items[start:start+limit], start, url)
+
+
+class RecentItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zot = zoteroapi.Zotero('1', cache=None)
+        self.zot.session = Listing()
+
+    def recent(self, days, concurrency=1):
+        return list(zotero_recently_added.recent_items(
+            self.zot, 'COLL', days, concurrency))
+
+    def test_one_page(self):
+        self.assertEqual(len(self.recent('1')), 24)
+        self.assertEqual(self.zot.session.requests, 1)
+
+    def test_two_pages(self):
+        self.assertEqual(len(self.recent('5')), 120)
+        self.assertEqual(self.zot.session.requests, 2)
+
+    def test_concurrency(self):
+        self.assertEqual(len(self.recent('5', concurrency=4)), 120)
+        # the first page, and at most the pages requested ahead of the caller
+        self.assertLessEqual(self.zot.session.requests, 1 + 4)
+
+    def test_without_days(self):
+        self.assertEqual(len(self.recent(None)), TOTAL)
+        self.assertEqual(self.zot.session.requests, TOTAL // LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -55,32 +55,204 @@ OPTIONS:
         and save to a single page.
   -labels:true
         Create a page for each label on the board.
+  -state:PATH
+        File in which to keep the sync cursor and a snapshot of the board
+        between runs (default: ~/trello2wiki_BOARD.json). Only the board
+        actions since the last run are read, and pages whose cards, preface
+        and category are unchanged are not saved again.
+  -resync:HOURS
+        Read the whole board again when the last full read is older than
+        this number of hours (default: 24). Use 0 to force a full read.
+  -stats:true
+        Print how many cards were rendered or reused and how many pages were
+        saved or left unchanged.
 
 """
 
+import os
+import sys
+import hashlib
+import collections
+
 import pywikibot
 import requests
 import json
 
 import dateutil.parser
-from datetime import datetime
-import urllib.parse
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
 
 import markdown
-import pypandoc
+
+import statefile
 
 
 headers = {
    "Accept": "application/json"
 }
 
-html_footer = '</table>'
-# <a href="{}">View on Trello</a></p></html>
+columns = ['Name', 'Description', 'Comments', 'Due']
+
+table_header = '{| class="wikitable sortable"'
+row_separator = '|- style="vertical-align: top;"'
+table_footer = '|}'
+
+# board actions that cannot be applied by re-reading the cards they name
+full_sync_actions = ('updateLabel', 'deleteLabel', 'updateBoard')
+list_actions = ('createList', 'updateList', 'moveListToBoard',
+                'moveListFromBoard')
+
+
+class _WikitextWriter(HTMLParser):
+    """Convert the html produced by Markdown to wikitext.
+
+    Only the elements that python-markdown generates are handled; the output
+    follows the layout that pandoc's mediawiki writer gives for the same
+    input, so that pages do not change when switching renderers.
+    """
+
+    inline = {'em': "''", 'i': "''", 'strong': "'''", 'b': "'''"}
+    blocks = ('p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li',
+              'blockquote', 'pre', 'hr')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.blocks_out = []
+        self.text = []
+        self.lists = []
+        self.links = []
+        self.pre = 0
+
+    def _flush(self):
+        text = ''.join(self.text)
+        if not self.pre:
+            text = ' '.join(text.split())
+        self.text = []
+        if text:
+            self.blocks_out.append((text, bool(self.lists)))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.inline:
+            self.text.append(self.inline[tag])
+        elif tag in ('ul', 'ol'):
+            self._flush()
+            self.lists.append('*' if tag == 'ul' else '#')
+        elif tag == 'li':
+            self._flush()
+            self.text.append(''.join(self.lists) + ' ')
+        elif tag == 'p' and self.lists:
+            # paragraphs of a loose list stay inside the list item
+            self.text.append(' ')
+        elif tag in self.blocks:
+            self._flush()
+            if tag == 'pre':
+                self.pre += 1
+                self.text.append('<pre>')
+            elif tag == 'blockquote':
+                self.blocks_out.append(('<blockquote>', False))
+            elif tag == 'hr':
+                self.blocks_out.append(('-----', False))
+            elif tag[0] == 'h':
+                self.text.append('=' * int(tag[1]) + ' ')
+        elif tag == 'br':
+            self.text.append('<br />')
+        elif tag == 'code' and not self.pre:
+            self.text.append('<code>')
+        elif tag == 'a':
+            self.links.append((attrs.get('href', ''), len(self.text)))
+        elif tag == 'img':
+            self.text.append('[{} {}]'.format(attrs.get('src', ''),
+                                              attrs.get('alt', '')).strip())
+
+    def handle_endtag(self, tag):
+        if tag in self.inline:
+            self.text.append(self.inline[tag])
+        elif tag in ('ul', 'ol'):
+            self._flush()
+            if self.lists:
+                self.lists.pop()
+        elif tag == 'pre':
+            self.text.append('</pre>')
+            self._flush()
+            self.pre -= 1
+        elif tag == 'blockquote':
+            self._flush()
+            self.blocks_out.append(('</blockquote>', False))
+        elif tag[0] == 'h' and tag in self.blocks:
+            self.text.append(' ' + '=' * int(tag[1]))
+            self._flush()
+        elif tag == 'p' and self.lists:
+            self.text.append(' ')
+        elif tag in self.blocks:
+            self._flush()
+        elif tag == 'code' and not self.pre:
+            self.text.append('</code>')
+        elif tag == 'a' and self.links:
+            href, start = self.links.pop()
+            label = ' '.join(''.join(self.text[start:]).split())
+            del self.text[start:]
+            if not href or label == href:
+                self.text.append(label or href)
+            else:
+                self.text.append('[{} {}]'.format(href, label))
+
+    def handle_data(self, data):
+        if not self.pre:
+            data = data.replace('|', '&#124;')
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.text.append('&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.text.append('&#{};'.format(name))
+
+    def wikitext(self):
+        self._flush()
+        out = []
+        in_list = False
+        for (text, list_item) in self.blocks_out:
+            # list items are kept on consecutive lines
+            if out:
+                out.append('\n' if in_list and list_item else '\n\n')
+            out.append(text)
+            in_list = list_item
+        return ''.join(out)
+
+
+def _html2wiki(html):
+    """Convert the html rendered from a card's Markdown to wikitext."""
+    writer = _WikitextWriter()
+    writer.feed(html or '')
+    writer.close()
+    return writer.wikitext()
+
+
+def _cell(text, marker='|'):
+    """Format one table cell; block markup must start on its own line."""
+    if text and (text[0] in '*#:;=' or text.startswith('----')):
+        return '{}\n{}'.format(marker, text)
+    return '{} {}'.format(marker, text).rstrip()
+
+
+def _render_row(card):
+    name = card['name'].replace('[', '&#91;').replace(']', '&#93;')
+    name = name.replace('|', '&#124;')
+    cells = ['[https://trello.com/c/{} {}]'.format(card['id'], name),
+             _html2wiki(card['description']),
+             _html2wiki(card['comments']),
+             card['due']]
+    return '\n'.join([row_separator] + [_cell(c) for c in cells])
+
+
+def _render_table(cards):
+    """Render the card dicts as a sortable wikitable."""
+    out = [table_header] + [_cell(c, '!') for c in columns]
+    out.extend([_render_row(card) for card in cards])
+    out.append(table_footer)
+    return '\n'.join(out)
 
-# We use Markdown on the comments, so table cell contents are wrapped in <p>s
-# Do the same for other cells to get matching margins
-row = ( '<tr><td><p><a href="https://trello.com/c/{id}">{name}</a></p></td>'
-        '<td>{description}</td><td>{comments}</td><td><p>{due}</p></td></tr>' )
 
 def _get_lists(key='', token='', lists_url='', headers='', query='', **kwargs):
     query = {
@@ -99,13 +271,56 @@ def _get_lists(key='', token='', lists_url='', headers='', query='', **kwargs):
     return {l['id']: l['name'] for l in lists}
 
 
-def _read_board(key='', token='', board_url='', headers='', query='', **kwargs):
+def _iter_actions(url, key='', token='', headers='', limit=1000, **params):
+    """Yield pages of the actions at `url`, newest first.
+
+    Trello returns at most `limit` (1000) actions per request, so older
+    actions are paged in with `before` until a short page is returned. Pages
+    are only requested as the caller consumes them.
+    """
+    query = {
+       'key': key,
+       'token': token,
+       'limit': limit,
+    }
+    query.update({k: v for (k, v) in params.items() if v})
+    while True:
+        response = requests.request(
+           "GET",
+           url,
+           headers=headers,
+           params=query
+        )
+        response.raise_for_status()
+        page = json.loads(response.text)
+        yield page
+        if len(page) < limit:
+            return
+        query['before'] = page[-1]['id']
+
+
+def _read_comments(url, key='', token='', headers='', **kwargs):
+    """Return all commentCard actions at `url`, grouped by card ID.
+
+    The comments nested in the cards endpoint are capped per card, so they
+    are read from the actions endpoint instead, one page at a time.
+    """
+    comments = {}
+    for page in _iter_actions(url, key=key, token=token, headers=headers,
+                              filter='commentCard'):
+        for a in page:
+            comments.setdefault(a['data']['card']['id'], []).append(a)
+    return comments
+
+
+def _read_board(key='', token='', board_url='', actions_url='', headers='',
+        query='', **kwargs):
 
     query = {
        'key': key,
        'token': token,
-       'actions': 'commentCard',
-       'fields': ['id', 'name', 'labels', 'desc', 'due', 'idList']
+       'fields': ['id', 'name', 'labels', 'desc', 'due', 'idList',
+                  'dateLastActivity']
     }
 
     response = requests.request(
@@ -116,48 +331,196 @@ def _read_board(key='', token='', board_url='', headers='', query='', **kwargs):
     )
 
     cards = json.loads(response.text)
+    comments = _read_comments(actions_url, key=key, token=token,
+                              headers=headers)
+    for c in cards:
+        c['actions'] = comments.get(c['id'], [])
+    return cards
+
+
+def _read_card(card_id, key='', token='', card_url='', headers='',
+        board_id=None, **kwargs):
+    """Fetch a single card; return None if it is gone from the board."""
+    query = {
+       'key': key,
+       'token': token,
+       'fields': ['id', 'name', 'labels', 'desc', 'due', 'idList',
+                  'dateLastActivity', 'closed', 'idBoard']
+    }
+
+    response = requests.request(
+       "GET",
+       card_url.format(card_id),
+       headers=headers,
+       params=query
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    card = json.loads(response.text)
+    if card.get('closed') or card.get('idBoard') != board_id:
+        return None
+    comments = _read_comments(card_url.format(card_id) + '/actions',
+                              key=key, token=token, headers=headers)
+    card['actions'] = comments.get(card_id, [])
+    return card
+
+
+def _read_actions(key='', token='', actions_url='', headers='', since=None,
+        **kwargs):
+    """Return the board actions newer than `since`, newest first."""
+    actions = []
+    for page in _iter_actions(actions_url, key=key, token=token,
+                              headers=headers, since=since):
+        actions.extend(page)
+    return actions
+
+
+def _latest_action(key='', token='', actions_url='', headers='', **kwargs):
+    """Return the newest action on the board, or None."""
+    page = next(_iter_actions(actions_url, key=key, token=token,
+                              headers=headers, limit=1))
+    return page[0] if page else None
+
+
+def _fingerprint(*values):
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def _card_fingerprint(c):
+    """Fingerprint everything that goes into a card's table row."""
+    return _fingerprint(c.get('dateLastActivity'), c.get('name'), c.get('due'),
+                        c.get('desc'), [a['data']['text'] for a in c['actions']])
+
+
+def _due(c):
+    if c.get('due'):
+        d = dateutil.parser.isoparse(c['due'])
+        return d.strftime("%Y-%m-%d")
+    return '--' # allow sorting by date
+
+
+def _render_card(c, rendered, stats):
+    """Return the row data for card `c`, rendering its Markdown to html.
+
+    Cards whose fingerprint matches the one stored in `rendered` are not
+    rendered again.
+    """
+    fingerprint = _card_fingerprint(c)
+    cached = rendered.get(c['id'])
+    if cached and cached['fingerprint'] == fingerprint:
+        stats['cards reused'] += 1
+        return cached['data']
+
+    data = {}
+    data['labels'] = [l['name'] for l in c['labels']]
+    comments_list = [markdown.markdown(a['data']['text']) for a in
+        c['actions']]
+    data['comments'] = '<HR>'.join(comments_list) # separate paragraphs
+    data['name'] = c.get('name')
+    data['id'] = c.get('id')
+    data['description'] = markdown.markdown(c.get('desc'))
+    data['due'] = _due(c)
+
+    rendered[c['id']] = {'fingerprint': fingerprint, 'data': data}
+    stats['cards rendered'] += 1
+    return data
+
+
+def _index_cards(cards):
+    """Group the cards by label and by list."""
     labels = {}
     lists = {}
 
     for c in cards:
-        data = {}
-        data['labels'] = [l['name'] for l in c['labels']]
-        comments_list = [markdown.markdown(a['data']['text']) for a in
-            c['actions']]
-        data['comments'] = '<HR>'.join(comments_list) # separate paragraphs
-        data['name'] = c.get('name')
-        data['id'] = c.get('id')
-        data['description'] = markdown.markdown(c.get('desc'))
-        data['due'] = c.get('due')
-        if data['due']:
-            d = dateutil.parser.isoparse(data['due'])
-            data['due'] = d.strftime("%Y-%m-%d")
-        else:
-            data['due'] = '--' # allow sorting by date
-
         listname = c['idList']
         if not listname in lists.keys():
             lists[listname] = []
-        lists[listname].append(data)
+        lists[listname].append(c)
 
-        for name in data['labels']:
+        for name in [l['name'] for l in c['labels']]:
             if not name in labels.keys():
                 labels[name] = []
-            labels[name].append(data)
+            labels[name].append(c)
     return labels, lists
 
 
-def _generate(target, cards, header, footer, options):
-    out = [header] + [row.format(**card) for card in cards] + [footer]
-    mw = pypandoc.convert_text(' '.join(out), 'mediawiki', format='html')
-    mw = mw.replace('{|', '{| class="wikitable sortable"')
-    mw = mw.replace('|-', '|- style="vertical-align: top;"')
-    # optional hack to remove pandoc-applied column widths
-    mw = mw.replace('!width="25%"|', '!')
-    mw = mw.replace('\n\n\n', '\n\n')
-
-    target.text = '\n\n'.join([options['preface'], mw, options['category']])
-    target.save('Updated from {}'.format(options['trello_url']))
+def _sync_board(state, options):
+    """Bring the local snapshot of the board up to date.
+
+    A full read of the board is done on the first run, when the last full
+    read is older than `resync` hours, or when an action cannot be applied
+    card by card (e.g., a label was renamed). Otherwise only the board
+    actions since the stored cursor are read, and the cards they touch are
+    fetched again.
+    """
+    now = datetime.now(tz=timezone.utc)
+    resync = timedelta(hours=float(options.get('resync') or 24))
+    full = ('synced' not in state or
+            now - datetime.fromisoformat(state['synced']) >= resync)
+
+    if not full:
+        actions = _read_actions(since=state['cursor'], **options)
+        full = any(a['type'] in full_sync_actions for a in actions)
+
+    if full:
+        # read the cursor first, so nothing between the two requests is lost
+        latest = _latest_action(**options)
+        cards = _read_board(**options)
+        state['cursor'] = latest['id'] if latest else None
+        state['synced'] = now.isoformat()
+        state['board_id'] = latest['data']['board']['id'] if latest else None
+        state['cards'] = {c['id']: c for c in cards}
+        state['lists'] = _get_lists(**options)
+        return
+
+    if not actions:
+        return
+    state['cursor'] = actions[0]['id']
+    if any(a['type'] in list_actions for a in actions):
+        state['lists'] = _get_lists(**options)
+    for card_id in {a['data']['card']['id'] for a in actions
+                    if 'card' in a['data']}:
+        state['cards'].pop(card_id, None)
+        card = _read_card(card_id, board_id=state['board_id'], **options)
+        if card:
+            state['cards'][card_id] = card
+
+
+def _save_page(target, text, fingerprint, state, stats, failures, options):
+    """Queue `text` to be saved to `target` unless the page is unchanged.
+
+    Pages are saved asynchronously by pywikibot's put queue, which keeps to
+    the put_throttle and maxlag settings, so the next page can be rendered
+    while this one is being saved. Pages that cannot be saved are added to
+    `failures` rather than stopping the run.
+    """
+    pagename = target.title()
+    if state['pages'].get(pagename) == fingerprint:
+        stats['pages unchanged'] += 1
+        return
+
+    def saved(page, err):
+        if err:
+            failures.append((pagename, err))
+            return
+        state['pages'][pagename] = fingerprint
+        stats['pages saved'] += 1
+
+    target.text = '\n\n'.join([options['preface'], text, options['category']])
+    target.save('Updated from {}'.format(options['trello_url']),
+                asynchronous=True, callback=saved)
+
+
+def _generate(target, cards, state, stats, failures, options):
+    fingerprint = _fingerprint(options['preface'], options['category'],
+                               [_card_fingerprint(c) for c in cards])
+    if state['pages'].get(target.title()) == fingerprint:
+        stats['pages unchanged'] += 1
+        return
+    rows = [_render_card(c, state['rendered'], stats) for c in cards]
+    _save_page(target, _render_table(rows), fingerprint, state, stats,
+               failures, options)
 
 def run(*args):
     print("running...")
@@ -185,53 +548,78 @@ def run(*args):
     print(options)
     board_url = 'https://api.trello.com/1/boards/{}/cards/open'
     lists_url = 'https://api.trello.com/1/boards/{}/lists/open'
+    actions_url = 'https://api.trello.com/1/boards/{}/actions'
     filter_url = 'https://trello.com/b/{}?filter=label:'
     trello_url = 'https://trello.com/b/{}'
     options['board_url'] = board_url.format(options['board'])
     options['filter_url'] = filter_url.format(options['board'])
     options['trello_url'] = trello_url.format(options['board'])
     options['lists_url'] = lists_url.format(options['board'])
-
-    labels, lists = _read_board(**options)
-
-    header = (  '<table><tr><th>Name</th><th>Description</th>'
-                '<th>Comments</th><th>Due</th></tr>')
+    options['actions_url'] = actions_url.format(options['board'])
+    options['card_url'] = 'https://api.trello.com/1/cards/{}'
+
+    state_file = options.get('state', os.path.expanduser(
+            os.path.join('~', 'trello2wiki_{}.json'.format(options['board']))))
+    state = statefile.load(state_file) or {}
+    state.setdefault('rendered', {})
+    state.setdefault('pages', {})
+    stats = collections.Counter()
+    failures = []
+    _sync_board(state, options)
+    cards = list(state['cards'].values())
+    listnames = state['lists']
+
+    # every page is generated; the page fingerprints skip the unchanged ones,
+    # and pages that failed to save last time are tried again
+    labels, lists = _index_cards(cards)
 
     if options.get('lists', None):
         print('processing lists...')
-        listnames = _get_lists(**options)
-        for (list, cards) in lists.items():
-            if not listnames.get(list, None): # hidden, etc.
+        for (list_id, cards) in lists.items():
+            if not listnames.get(list_id, None): # hidden, etc.
                 continue
-            trello_link = board_url
-            pagename = ' '.join([options['pagename_prefix'], listnames[list]])
-            footer = html_footer.format(trello_link)
+            pagename = ' '.join([options['pagename_prefix'], listnames[list_id]])
             target = pywikibot.Page(site, pagename)
-            _generate(target, cards, header, footer, options)
+            _generate(target, cards, state, stats, failures, options)
 
     if options.get('outline', None):
-        listnames = _get_lists(**options)
         pagename = ' '.join([options['pagename_prefix'], 'outline'])
         target = pywikibot.Page(site, pagename)
-        dl = ['<dl>']
-        for (list, cards) in lists.items():
-            if not listnames.get(list, None): # hidden, etc.
+        dl = []
+        for (list_id, cards) in lists.items():
+            if not listnames.get(list_id, None): # hidden, etc.
                 continue
-            dl.append('<dt>{}</dt>'.format(listnames[list]))
-            dl.extend(['<dd>{}</dd>'.format(c['name']) for c in cards])
-        dl.append('</dl>')
-        mw = pypandoc.convert_text(' '.join(dl), 'mediawiki', format='html')
-        target.text = '\n\n'.join([options['preface'], mw, options['category']])
-        target.save('Updated from {}'.format(options['trello_url']))
+            dl.append('; {}'.format(listnames[list_id]))
+            dl.extend([': {}'.format(c['name']) for c in cards])
+        mw = '\n'.join(dl)
+        fingerprint = _fingerprint(options['preface'], options['category'], mw)
+        _save_page(target, mw, fingerprint, state, stats, failures,
+                   options)
 
     if options.get('labels', None):
         for (label, cards) in labels.items():
-            cards = sorted(cards, key=lambda d: d['due'])
-            trello_link = options['filter_url'] + urllib.parse.quote(label)
-            footer = html_footer.format(trello_link)
+            cards = sorted(cards, key=_due)
             pagename = ' '.join([options['pagename_prefix'], label])
             target = pywikibot.Page(site, pagename)
-            _generate(target, cards, header, footer, options)
+            _generate(target, cards, state, stats, failures, options)
+
+    # wait for the queued saves to finish
+    pywikibot.stopme()
+
+    # forget the rendered html of cards that have left the board
+    state['rendered'] = {k: v for (k, v) in state['rendered'].items()
+                         if k in state['cards']}
+    statefile.save(state_file, state)
+
+    if options.get('stats', None):
+        for key in ('cards rendered', 'cards reused', 'pages saved',
+                    'pages unchanged'):
+            print('{}: {}'.format(key, stats[key]))
+
+    for (pagename, err) in failures:
+        pywikibot.error('Could not save {}: {}'.format(pagename, err))
+    if failures:
+        sys.exit('{} page(s) could not be saved'.format(len(failures)))
 
 if __name__ == '__main__':
     run()
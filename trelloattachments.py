@@ -30,8 +30,19 @@ OPTIONS:
   -category:CATEGORY
         Wikitext string containing the category or categories for the pages,
         e.g., [[Category:Foo]]
+  -basedir:PATH
+        Directory in which to save the attachments (default: current
+        directory)
+  -workers:N
+        Number of attachments to download at the same time (default: 4)
+  -manifest:PATH
+        Database recording the attachments already downloaded (default:
+        .manifest in the -basedir directory). Do not include the extension.
 """
 import os
+import dbm
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pywikibot
 import requests
@@ -41,32 +52,108 @@ import urllib.parse
 
 from slugify import slugify
 
-def download_attachment(headers, url, name, basedir):
-    dirname = os.path.join(basedir, name.strip())
-    decoded_url = urllib.parse.unquote(url)
-    filename = os.path.join(dirname, os.path.basename(decoded_url))
-    if os.path.exists(filename):
-        print('EXISTS: {}'.format(filename))
-        return
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    if url.startswith('https://trello.com/1/cards/'):
-        r = requests.request("GET", url, headers=headers)
-        with open(filename, 'wb') as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
+CHUNK_SIZE = 1024 * 1024
+
+def _session(headers, workers):
+    """Return a requests session with a connection pool for the workers."""
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('https://', adapter)
+    return session
+
+def _sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _filename(attachment, dirname):
+    decoded_url = urllib.parse.unquote(attachment['url'])
+    return os.path.join(dirname, os.path.basename(decoded_url))
+
+def download_attachment(session, attachment, store):
+    """Download one attachment into the content store; return its hash.
+
+    The file is written to a `.part` file first, and only moved into the
+    store once its size matches the size Trello reports for the attachment,
+    so an interrupted download is resumed (with an HTTP Range request) on the
+    next run. Files are stored once under their SHA-256 hash, however many
+    cards they are attached to.
+    """
+    url = attachment['url']
+    expected = attachment.get('bytes')
+    tmpdir = os.path.join(store, 'tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+    part = os.path.join(tmpdir, attachment['id'] + '.part')
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if not expected or offset < expected:
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with session.get(url, headers=headers, stream=True) as r:
+            # 416: nothing left to read, the .part file is already complete
+            if r.status_code != 416:
+                r.raise_for_status()
+                # the server may ignore the range and send the whole file
+                mode = 'ab' if r.status_code == 206 else 'wb'
+                with open(part, mode) as fd:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        fd.write(chunk)
+
+    size = os.path.getsize(part)
+    if expected and size != expected:
+        # start again on the next run rather than resuming a bad file
+        os.remove(part)
+        raise IOError('{}: got {} of {} bytes'.format(url, size, expected))
+    digest = _sha256(part)
+    stored = _stored(store, digest)
+    if os.path.exists(stored):
+        os.remove(part)
     else:
-        with open(filename + '.html', 'w') as fd:
-            fd.write('<a href="{}">{}</a>'.format(url, name))
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        os.replace(part, stored)
+    return digest
+
+def _stored(store, digest):
+    return os.path.join(store, digest[:2], digest)
+
+def _adopt(filename, store):
+    """Add a file downloaded before the manifest existed to the content
+    store; return its hash."""
+    digest = _sha256(filename)
+    stored = _stored(store, digest)
+    if not os.path.exists(stored):
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        os.link(filename, stored)
+    return digest
+
+def _link(source, filename):
+    """Hard link the stored file `source` to `filename` in a card directory."""
+    if os.path.exists(filename):
+        if os.path.samefile(source, filename):
+            return
+        os.remove(filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    os.link(source, filename)
+
+def _move_card(manifest, card, dirname):
+    """Move the directory of a renamed card instead of downloading again."""
+    key = 'card:' + card['id']
+    old = json.loads(manifest[key])['dirname'] if key in manifest else None
+    if old and old != dirname and os.path.isdir(old) and \
+            not os.path.exists(dirname):
+        print('RENAMED: {} -> {}'.format(old, dirname))
+        os.rename(old, dirname)
+    manifest[key] = json.dumps({'dirname': dirname})
 
 def read_board(
     key='', token='', board_url='', dry_run=False,
-    headers='', query='', basedir='.',
+    headers='', query='', basedir='.', workers='4', manifest=None,
     **kwargs):
 
+    # comments are not used here, so they are not requested with the cards
     query = {
-       'actions': 'commentCard',
        'fields': ['id', 'name', 'labels', 'desc', 'due'],
        'attachments': 'true'
     }
@@ -87,15 +174,71 @@ def read_board(
         print('Error loading data')
         return
 
-    for c in cards:
-        print(c['name'])
-        name = slugify(c['name'], max_length=80)
-        for a in c['attachments']:
-            url = a['url']
-            if dry_run:
-                print(url)
-            else:
-                download_attachment(headers, url, name, basedir)
+    store = os.path.join(basedir, '.store')
+    manifest_file = manifest or os.path.join(basedir, '.manifest')
+    workers = int(workers)
+    session = _session(headers, workers)
+    failures = []
+    with dbm.open(manifest_file, 'c') as db, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = {}
+        for c in cards:
+            print(c['name'])
+            name = slugify(c['name'], max_length=80)
+            dirname = os.path.join(basedir, name.strip())
+            if not dry_run:
+                _move_card(db, c, dirname)
+            for a in c['attachments']:
+                url = a['url']
+                filename = _filename(a, dirname)
+                if dry_run:
+                    print(url)
+                    continue
+                if not url.startswith('https://trello.com/1/cards/'):
+                    os.makedirs(dirname, exist_ok=True)
+                    with open(filename + '.html', 'w') as fd:
+                        fd.write('<a href="{}">{}</a>'.format(url, name))
+                    continue
+                key = 'attachment:' + a['id']
+                entry = json.loads(db[key]) if key in db else {}
+                if entry.get('date') == a.get('date') and \
+                        entry.get('bytes') == a.get('bytes') and \
+                        os.path.exists(_stored(store, entry['sha256'])):
+                    # known content: only the card's link may be missing
+                    _link(_stored(store, entry['sha256']), filename)
+                    print('EXISTS: {}'.format(filename))
+                    continue
+                if not entry and a.get('bytes') and \
+                        os.path.isfile(filename) and \
+                        os.path.getsize(filename) == a['bytes']:
+                    # downloaded by an earlier version of this script
+                    job = executor.submit(_adopt, filename, store)
+                    jobs[job] = (c, a, filename, 'ADOPTED')
+                    continue
+                job = executor.submit(download_attachment, session, a, store)
+                jobs[job] = (c, a, filename, 'DOWNLOADED')
+
+        # the manifest is only written from this thread
+        for job in as_completed(jobs):
+            c, a, filename, done = jobs[job]
+            try:
+                digest = job.result()
+            except (requests.RequestException, IOError) as e:
+                failures.append(a['url'])
+                print('FAILED: {} ({})'.format(a['url'], e))
+                continue
+            _link(_stored(store, digest), filename)
+            db['attachment:' + a['id']] = json.dumps({
+                'card': c['id'],
+                'date': a.get('date'),
+                'bytes': a.get('bytes'),
+                'sha256': digest,
+            })
+            print('{}: {}'.format(done, filename))
+
+    if failures:
+        print('{} attachment(s) could not be downloaded; run again to '
+              'resume them'.format(len(failures)))
 
 
 def run(*args):
@@ -2,6 +2,10 @@
 
 Upload a formatted list of items from a Zotero collection to a wiki page.
 
+Several collections can be uploaded in one run with -collections. The
+library is synced once, and an item that belongs to several collections is
+only read and formatted once.
+
 OPTIONS:
 
   -key:KEY (required)
@@ -10,17 +14,51 @@ OPTIONS:
         'group' or 'user'
   -user_id:ID (required)
         The ID of the Zotero user
-  -collection:COLLECTION_ID (required)
+  -collection:COLLECTION_ID (required unless -collections is given)
         The ID of the collection to retrieve items from
-  -pagename:PAGENAME (required)
+  -pagename:PAGENAME (required unless -item_prefix is given)
         Target wiki pagename
+  -collections:COLLECTION_ID=PAGENAME;...
+        Upload several collections, each to its own page. The value can
+        also be the path of a file with one COLLECTION_ID=PAGENAME pair
+        per line.
+  -item_prefix:PREFIX
+        Save each item to its own page, named PREFIX followed by the Zotero
+        item key. A page is only saved when its text has changed since its
+        last save. If -pagename is given, that page transcludes the item
+        pages.
   -preface:TEXT
         Text to insert at the top of the page
+  -mirror:PATH
+        SQLite database in which to keep a local copy of the library
+        (default: ~/zotero2wiki_TYPE_ID.sqlite). Only items changed since
+        the last run are fetched from Zotero.
+  -cache:PATH
+        Cache for Zotero API responses (default: ~/.zotero_cache.sqlite).
+        Cached responses are revalidated with a conditional request.
+  -cache_size:MB
+        Maximum size of the cache (default: 100)
+  -cache_ttl:HOURS
+        How long item types and other data that does not belong to the
+        library are used from the cache without revalidation (default: 24)
+  -stats:true
+        Print the cache hit and miss counts
+  -concurrency:N
+        Number of requests to the Zotero API to run at the same time
+        (default: 1)
 """
 
+import os
 import sys
+import json
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
 import pywikibot
-from pyzotero import zotero
+import requests
+
+import zoteroapi
 
 TEMPLATE = """{{{{report
 | cover = {cover}
@@ -37,22 +75,131 @@ TEMPLATE = """{{{{report
 }}}}"""
 
 
+def open_mirror(path):
+    """Open (and create if needed) the local mirror of a Zotero library."""
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY,
+            version INTEGER,
+            parent TEXT,
+            item TEXT);
+        CREATE INDEX IF NOT EXISTS items_parent ON items (parent);
+        CREATE TABLE IF NOT EXISTS collection_items (
+            collection TEXT,
+            key TEXT,
+            PRIMARY KEY (collection, key));
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS saved_pages (
+            page TEXT PRIMARY KEY,
+            digest TEXT);
+        """)
+    return db
+
+def _store_item(db, item):
+    data = item['data']
+    db.execute('DELETE FROM collection_items WHERE key = ?', (item['key'],))
+    if data.get('deleted', False): # in the trash
+        db.execute('DELETE FROM items WHERE key = ?', (item['key'],))
+        return
+    db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+        (item['key'], item['version'], data.get('parentItem', None),
+         json.dumps(item)))
+    db.executemany('INSERT INTO collection_items VALUES (?, ?)',
+        [(c, item['key']) for c in data.get('collections', [])])
+
+def sync_mirror(zot, db, concurrency=1):
+    """Update the mirror using Zotero's library version protocol.
+
+    Only the items modified since the library version of the last sync are
+    fetched (in batches of 50, `concurrency` at a time), and items deleted
+    since then are removed. If nothing has changed, Zotero answers the first
+    request with a 304 response. Return the number of items updated.
+    """
+    row = db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+    version = int(row[0]) if row else 0
+    r = zot.request('items', format='versions', since=version,
+            includeTrashed=1,
+            headers={'If-Modified-Since-Version': str(version)})
+    if r.status_code == 304:
+        return 0
+
+    keys = list(r.json())
+    batches = [keys[i:i+50] for i in range(0, len(keys), 50)]
+    fetch = lambda batch: zot.request('items', itemKey=','.join(batch),
+            includeTrashed=1, limit=50).json()
+    with ThreadPoolExecutor(max_workers=int(concurrency)) as executor:
+        # the mirror is only written from this thread
+        for items in executor.map(fetch, batches):
+            for item in items:
+                _store_item(db, item)
+    if version:
+        deleted = zot.request('deleted', since=version).json()
+        for key in deleted.get('items', []):
+            db.execute('DELETE FROM items WHERE key = ?', (key,))
+            db.execute('DELETE FROM collection_items WHERE key = ?', (key,))
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+        (r.headers['Last-Modified-Version'],))
+    db.commit()
+    return len(keys)
+
+def collection_items(db, collections):
+    """Return the items in each of `collections` from the mirror, newest
+    first, and their child items grouped by the parent's key.
+
+    Items that belong to several collections are only read once, and the
+    same item object is shared by the collections' lists.
+    """
+    marks = ','.join('?' * len(collections))
+    rows = db.execute("""SELECT collection, key FROM collection_items
+        WHERE collection IN ({})""".format(marks), collections)
+    members = {c: [] for c in collections}
+    for (collection, key) in rows:
+        members[collection].append(key)
+    keys = set(k for c in members.values() for k in c)
+
+    shared = {}
+    rows = db.execute('SELECT key, item FROM items')
+    for (key, item) in rows:
+        if key in keys:
+            shared[key] = json.loads(item)
+    children = {}
+    rows = db.execute('SELECT parent, item FROM items WHERE parent IS NOT NULL')
+    for (parent, item) in rows:
+        if parent in keys:
+            children.setdefault(parent, []).append(json.loads(item))
+
+    items = {}
+    for (collection, c) in members.items():
+        items[collection] = [shared[k] for k in c if k in shared]
+        items[collection].sort(key=lambda i: i['data'].get('dateAdded', ''),
+                reverse=True)
+    return items, children
+
 def zotero_request(user_id=None, key=None, library_type='group',
-        collection=None, **kwargs):
-    """Retrieve data from the Zotero API."""
-
-    zot = zotero.Zotero(user_id, library_type, api_key=key)
-    zot.add_parameters(
-                sort='dateAdded',
-                direction='desc'
-            )
+        collections=(), mirror=None, cache=zoteroapi.DEFAULT_CACHE,
+        cache_size=100, cache_ttl=24, stats=None, concurrency=1, **kwargs):
+    """Sync the local mirror with the Zotero API and read the collections."""
+
+    zot = zoteroapi.Zotero(user_id, library_type, api_key=key, cache=cache,
+            cache_size=cache_size, cache_ttl=cache_ttl)
+    if not mirror:
+        mirror = os.path.expanduser(os.path.join('~',
+            'zotero2wiki_{}_{}.sqlite'.format(library_type, user_id)))
+    db = open_mirror(mirror)
     try:
-        items = zot.everything(zot.collection_items(collection))
-    except HTTPError:
+        updated = sync_mirror(zot, db, concurrency)
+    except requests.HTTPError:
         sys.exit('HTTP Error')
-    return zot, items
+    print('{} item(s) updated from Zotero'.format(updated))
+    if stats:
+        print(zot.cache_summary())
+    items, children = collection_items(db, list(collections))
+    return db, items, children
 
-def process_item(zot, i):
+def process_item(i, children):
     if i['data']['itemType'] in ['note', 'attachment']:
         return None
     data = {}
@@ -73,8 +220,8 @@ def process_item(zot, i):
         k, sep, v = e.partition(':')
         data[k.lower()] = v.strip()
 
-    if i['meta'].get('numChildren', 0) > 0:
-        attachments = zot.children(i['key'])
+    attachments = children.get(i['key'], [])
+    if attachments:
         attachments_list = []
         for a in attachments:
             if a['data'].get('itemType', None) == 'note':
@@ -89,6 +236,82 @@ def process_item(zot, i):
     return data
 
 
+def save_items(site, db, texts, summary, options):
+    """Save one page per item, named with the item prefix and the item key.
+
+    `texts` maps the item keys to the formatted item texts.
+
+    A page is only saved when its text differs from the text recorded (as a
+    digest) at its last save, so changed or deleted attachments and a
+    changed template are written out too. Saves are queued, so pywikibot
+    runs them in the background within the put throttle. Return the lists
+    to which the saved (page, digest) pairs and the failures are added as
+    the queued saves finish.
+    """
+    saved = dict(db.execute('SELECT page, digest FROM saved_pages'))
+    done = []
+    failures = []
+    for (key, text) in texts.items():
+        pagename = options['item_prefix'] + key
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if saved.get(pagename) == digest:
+            continue
+        if options.get('dry-run', None):
+            print(pagename)
+            print(text)
+            continue
+
+        def callback(page, err, pagename=pagename, digest=digest):
+            if err:
+                failures.append((pagename, err))
+            else:
+                done.append((pagename, digest))
+
+        target = pywikibot.Page(site, pagename)
+        target.text = text
+        target.save(summary, asynchronous=True, callback=callback)
+
+    return done, failures
+
+def record_saves(db, done, failures):
+    """Record the digests of the saved item pages, once the queued saves
+    have finished."""
+    pywikibot.stopme()
+    db.executemany('INSERT OR REPLACE INTO saved_pages VALUES (?, ?)', done)
+    db.commit()
+    print('{} item page(s) saved'.format(len(done)))
+    for (pagename, err) in failures:
+        pywikibot.error('Could not save {}: {}'.format(pagename, err))
+
+def parse_collections(value):
+    """Return the (collection, pagename) pairs given with -collections."""
+    if os.path.isfile(value):
+        with open(value) as f:
+            pairs = f.read().splitlines()
+    else:
+        pairs = value.split(';')
+    collections = []
+    for pair in pairs:
+        collection, sep, pagename = pair.partition('=')
+        if collection.strip():
+            collections.append((collection.strip(), pagename.strip()))
+    return collections
+
+def save_page(site, pagename, mw, summary, options):
+    if options.get('preface', None):
+        mw = [options['preface']] + mw
+
+    if options.get('dry-run', None):
+        print('\n\n'.join(mw))
+        return
+    target = pywikibot.Page(site, pagename)
+    text = '\n\n'.join(mw)
+    if target.exists() and target.text == text:
+        print('No changes to {}'.format(pagename))
+        return
+    target.text = text
+    target.save(summary)
+
 def run(*args):
     local_args = pywikibot.handle_args(args)
     required = ['key', 'library_type', 'user_id', 'collection', 'pagename']
@@ -97,31 +320,64 @@ def run(*args):
     for arg in local_args:
         option, sep, value = arg.partition(':')
         options[option.strip('-')] = value
+    if options.get('collections', None):
+        required.remove('collection')
+        required.remove('pagename')
+    elif options.get('item_prefix', None):
+        required.remove('pagename') # the list page is optional
     for option in required:
         if not options.get(option, False):
             value = pywikibot.input('Please enter a value for ' + option)
             options[option] = value
 
+    if options.get('collections', None):
+        collections = parse_collections(options.pop('collections'))
+    else:
+        collections = [(options['collection'], options.get('pagename', None))]
+
     site = pywikibot.Site()
-    mw = []
 
     tpl = options.get('template', TEMPLATE)
 
-    zot, items = zotero_request(**options)
-    for i in items:
-        data = process_item(zot, i)
+    db, items, children = zotero_request(
+            collections=[c for (c, pagename) in collections], **options)
+
+    # each item is formatted once, however many collections it is in
+    unique = {}
+    for (collection, pagename) in collections:
+        for i in items[collection]:
+            unique.setdefault(i['key'], i)
+    texts = {}
+    for (key, i) in unique.items():
+        data = process_item(i, children)
         if data:
-            mw.append(tpl.format(**data))
+            texts[key] = tpl.format(**data)
 
-    if options.get('preface', None):
-        mw = [options['preface']] + mw
+    done = None
+    if options.get('item_prefix', None):
+        if len(collections) == 1:
+            summary = 'Updated from Zotero collection {}'.format(
+                    collections[0][0])
+        else:
+            summary = 'Updated from Zotero'
+        done, failures = save_items(site, db, texts, summary, options)
 
-    if options.get('dry-run', None):
-        print('\n\n'.join(mw))
-    else:
-        target = pywikibot.Page(site, options['pagename'])
-        target.text = '\n\n'.join(mw)
-        target.save('Updated from Zotero collection {collection}'.format(**options))
+    for (collection, pagename) in collections:
+        if not pagename:
+            continue
+        keys = [i['key'] for i in items[collection] if i['key'] in texts]
+        if options.get('item_prefix', None):
+            mw = ['{{{{:{}{}}}}}'.format(options['item_prefix'], k)
+                  for k in keys]
+        else:
+            mw = [texts[k] for k in keys]
+        save_page(site, pagename, mw,
+                'Updated from Zotero collection {}'.format(collection),
+                options)
+
+    if done is not None:
+        record_saves(db, done, failures)
+    db.close()
 
 if __name__ == '__main__':
     run()
@@ -34,17 +34,37 @@ OPTIONS:
         Text to insert at the top of the page
   -days:DAYS
         Return items added in the most recent DAYS
+  -cache:PATH
+        Cache for Zotero API responses (default: ~/.zotero_cache.sqlite).
+        Cached responses are revalidated with a conditional request.
+  -cache_size:MB
+        Maximum size of the cache (default: 100)
+  -cache_ttl:HOURS
+        How long item types and other data that does not belong to the
+        library are used from the cache without revalidation (default: 24)
+  -stats:true
+        Print the cache hit and miss counts
+  -split:type|N
+        Write the bibliography to subpages of PAGENAME, one per item type
+        ('type') or N entries each, and transclude them on PAGENAME. Only
+        the subpages whose content has changed are saved; subpages that are
+        no longer transcluded are emptied.
+  -concurrency:N
+        Number of requests to the Zotero API to run at the same time
+        (default: 1)
 """
 
+import re
 import sys
 import requests
 import datetime
 
-from pyzotero import zotero
 import pypandoc
 import pywikibot
 from bs4 import BeautifulSoup
 
+import zoteroapi
+
 # ITEM_TYPES = [
 #     "journalArticle",
 #     "book",
@@ -62,25 +82,81 @@ from bs4 import BeautifulSoup
 #     "document"
 #     ]
 
-def _html2wiki(input):
-    """Convert the html returned by Zotero to wikitext."""
+# Placeholder paragraph put between the entries of a batched conversion
+SENTINEL = 'ZOTEROBIBENTRY{:06d}'
+# An entry whose first character pandoc escaped in a batched conversion
+LEADING_ESCAPE = re.compile(r'\s*\\[*#;:]')
+
+def _unwrap(input):
     soup = BeautifulSoup(input, 'html.parser')
     for d in ['csl-entry', 'csl-bib-body']:
         for div in soup.find_all('div', d):
             div.unwrap()
-    w = pypandoc.convert_text(str(soup), 'mediawiki', format='html')
+    return str(soup)
+
+def _clean(w):
     w = ' '.join(w.split()) #conflate whitespaces
     # colons mess up the definition lists
     w = w.replace(':', '&#58;')
     return w
 
-def _process_zotero_item(zot, item):
-    """Convert bibliography entry to a wikitext paragraph."""
+def _html2wiki(input):
+    """Convert the html returned by Zotero to wikitext."""
+    w = pypandoc.convert_text(_unwrap(input), 'mediawiki', format='html')
+    return _clean(w)
+
+def _html2wiki_batch(inputs, chunk_size=500):
+    """Convert a list of bibliography entries with one pandoc call per chunk.
+
+    The entries are joined with numbered sentinel paragraphs, and the output
+    is split on them again. If the sentinels do not come back as expected
+    (e.g., an entry's markup swallowed one), the entries of that chunk are
+    converted one at a time instead. So are entries starting with one of
+    `*#;:`, which pandoc escapes with a backslash in all but the first
+    paragraph of a document.
+    """
     out = []
-    out.append('; ' + _html2wiki(item['bib']))
+    for start in range(0, len(inputs), chunk_size):
+        chunk = inputs[start:start+chunk_size]
+        html = []
+        for (n, input) in enumerate(chunk):
+            html.append('<p>{}</p>'.format(SENTINEL.format(n)))
+            html.append(_unwrap(input))
+        w = pypandoc.convert_text('\n'.join(html), 'mediawiki', format='html')
+        parts = re.split(r'^(ZOTEROBIBENTRY\d{6})$', w, flags=re.MULTILINE)
+        markers = parts[1::2]
+        if parts[0].strip() or \
+                markers != [SENTINEL.format(n) for n in range(len(chunk))]:
+            out.extend([_html2wiki(input) for input in chunk])
+            continue
+        out.extend([_html2wiki(input) if LEADING_ESCAPE.match(entry)
+                    else _clean(entry)
+                    for (input, entry) in zip(chunk, parts[2::2])])
+    return out
+
+def _group_children(items):
+    """Group the child items (attachments, notes) by their parent's key.
+
+    The collection listing already contains the child items of the items in
+    the collection, so they do not need to be requested for each parent.
+    """
+    children = dict()
+    for item in items:
+        parent = item['data'].get('parentItem', None)
+        if parent:
+            children.setdefault(parent, []).append(item)
+    return children
+
+def _process_zotero_item(item, children, entry):
+    """Convert bibliography entry to a wikitext paragraph.
+
+    `entry` is the item's bibliography entry, already converted to wikitext.
+    """
+    out = []
+    out.append('; ' + entry)
 
     if item['meta'].get('numChildren', 0) > 0:
-        attachments = zot.children(item['key'])
+        attachments = children.get(item['key'], [])
         for a in attachments:
             if a['data'].get('itemType', None) == 'note':
                 continue
@@ -100,45 +176,112 @@ def _process_zotero_item(zot, item):
     return '\n'.join(out)
 
 
-def bibliography(user_id=None, key=None, library_type='group', collection=None,
-                days=None, **kwargs):
-    """Generate a wikitext bibliography via the Zotero API."""
+def sections(user_id=None, key=None, library_type='group', collection=None,
+                days=None, cache=zoteroapi.DEFAULT_CACHE, cache_size=100,
+                cache_ttl=24, stats=None, concurrency=1, **kwargs):
+    """Retrieve the bibliography via the Zotero API, as a list of
+    (item type, wikitext entries) sections."""
 
-    zot = zotero.Zotero(user_id, library_type, api_key=key)
-    zot.add_parameters(
+    zot = zoteroapi.Zotero(user_id, library_type, api_key=key, cache=cache,
+                cache_size=cache_size, cache_ttl=cache_ttl)
+    try:
+        items = zot.everything('collections/{}/items'.format(collection),
+                concurrency=concurrency,
                 include='bib,data',
                 style='chicago-author-date',
                 linkwrap='0',
                 sort='dateAdded',
                 direction='desc'
             )
-    try:
-        items = zot.everything(zot.collection_items(collection))
-    except HTTPError:
+        item_types = zot.request('/itemTypes').json()
+    except requests.HTTPError:
         sys.exit('HTTP Error')
-
-    item_types = zot.item_types()
+    if stats:
+        print(zot.cache_summary())
     # item_types_dict = dict()
     # for type in item_types:
     #     item_types_dict[type['itemType']] = type['localized']
 
+    children = _group_children(items)
+    items = [item for item in items
+             if item['data'].get('itemType', '') not in ('note', 'attachment')]
+    entries = _html2wiki_batch([item['bib'] for item in items])
     bib = dict()
-    for item in items:
+    for (item, entry) in zip(items, entries):
         item_type = item['data'].get('itemType', '')
-        if item_type in ('note', 'attachment'):
-            continue
         if not item_type in bib:
             bib[item_type] = []
-        bib[item_type].append(_process_zotero_item(zot, item))
+        bib[item_type].append(_process_zotero_item(item, children, entry))
 
     out = []
     for i in item_types: # or ITEM_TYPES if we want manual sorting
         if not i['itemType'] in bib:
             continue
-        out.append('\n=={}=='.format(i['localized']))
-        out.extend(bib[i['itemType']])
+        out.append((i['localized'], bib[i['itemType']]))
+    return out
+
+def _format(sections):
+    out = []
+    for (heading, entries) in sections:
+        if heading:
+            out.append('\n=={}=='.format(heading))
+        out.extend(entries)
     return '\n'.join(out)
 
+def bibliography(**kwargs):
+    """Generate a wikitext bibliography via the Zotero API."""
+    return _format(sections(**kwargs))
+
+def shards(sections, pagename, split):
+    """Split the bibliography into subpages of `pagename`.
+
+    With `split` set to 'type', there is one subpage per item type, and the
+    headings stay on the index page. With a number, each subpage holds that
+    many entries. Return the index page text and a list of (subpage name,
+    text) pairs.
+    """
+    index = []
+    subpages = []
+    if split == 'type':
+        for (heading, entries) in sections:
+            subpage = '{}/{}'.format(pagename, heading)
+            index.append('\n=={}==\n{{{{:{}}}}}'.format(heading, subpage))
+            subpages.append((subpage, '\n'.join(entries)))
+        return '\n'.join(index), subpages
+
+    size = int(split)
+    flat = [(heading, entry) for (heading, entries) in sections
+            for entry in entries]
+    for n in range(0, len(flat), size):
+        chunk = []
+        for (i, (heading, entry)) in enumerate(flat[n:n+size], n):
+            # a heading opens its section, wherever it falls
+            if i == 0 or flat[i-1][0] != heading:
+                chunk.append((heading, [entry]))
+            else:
+                chunk.append((None, [entry]))
+        subpage = '{}/{}'.format(pagename, n // size + 1)
+        index.append('{{{{:{}}}}}'.format(subpage))
+        subpages.append((subpage, _format(chunk)))
+    return '\n'.join(index), subpages
+
+def _save(site, pagename, text, summary):
+    """Save `text` to `pagename` unless the page already has that text."""
+    target = pywikibot.Page(site, pagename)
+    if target.exists() and target.text.strip() == text.strip():
+        print('No changes to {}'.format(pagename))
+        return
+    target.text = text
+    target.save(summary)
+
+def _transcluded(site, pagename):
+    """Return the subpages of `pagename` that the page now transcludes."""
+    page = pywikibot.Page(site, pagename)
+    if not page.exists():
+        return set()
+    return set(re.findall(r'\{{\{{:({}/[^{{}}|]+)\}}\}}'.format(
+        re.escape(pagename)), page.text))
+
 def run(*args):
     options = {}
     local_args = pywikibot.handle_args(args)
@@ -156,15 +299,27 @@ def run(*args):
             options[option] = value
 
     site = pywikibot.Site()
-    mw = bibliography(**options)
+    summary = 'Updated from Zotero library'
+    old = _transcluded(site, options['pagename'])
+
+    subpages = []
+    if options.get('split', None):
+        mw, subpages = shards(sections(**options), options['pagename'],
+                              options['split'])
+        for (subpage, text) in subpages:
+            _save(site, subpage, text, summary)
+    else:
+        mw = bibliography(**options)
 
     if options.get('preface', None):
         mw = '\n'.join([options['preface'], mw])
 
-    target = pywikibot.Page(site, options['pagename'])
+    _save(site, options['pagename'], mw, summary)
 
-    target.text = mw
-    target.save('Updated from Zotero library')
+    # e.g., fewer entries than before, or an item type that has gone
+    for subpage in sorted(old - set(name for (name, text) in subpages)):
+        print('Emptying {}, which is no longer used'.format(subpage))
+        _save(site, subpage, '', summary)
 
 if __name__ == '__main__':
     run()
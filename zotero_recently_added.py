@@ -34,16 +34,30 @@ OPTIONS:
         Text to insert at the top of the page
   -days:DAYS
         Return items added in the most recent DAYS
+  -cache:PATH
+        Cache for Zotero API responses (default: ~/.zotero_cache.sqlite).
+        Cached responses are revalidated with a conditional request.
+  -cache_size:MB
+        Maximum size of the cache (default: 100)
+  -cache_ttl:HOURS
+        How long item types and other data that does not belong to the
+        library are used from the cache without revalidation (default: 24)
+  -stats:true
+        Print the cache hit and miss counts
+  -concurrency:N
+        Number of requests to the Zotero API to run at the same time
+        (default: 1)
 """
 
 import sys
 import requests
 import datetime
 
-from pyzotero import zotero
 import pypandoc
 import pywikibot
 
+import zoteroapi
+
 
 def _html2wiki(input):
     """Convert the html returned by Zotero to wikitext."""
@@ -59,7 +73,7 @@ def _process_zotero_item(zot, item):
     out.append(_html2wiki(item['bib']))
 
     if item['meta'].get('numChildren', 0) > 0:
-        attachments = zot.children(item['key'])
+        attachments = zot.everything('items/{}/children'.format(item['key']))
 
         for a in attachments:
             if a['data'].get('itemType', None) == 'note':
@@ -74,36 +88,51 @@ def _process_zotero_item(zot, item):
     return ' '.join(out)
 
 
-def bibliography(user_id=None, key=None, library_type='group', collection=None,
-                days=None, **kwargs):
-    """Generate a wikitext bibliography via the Zotero API."""
-
-    out = []
+def recent_items(zot, collection, days=None, concurrency=1):
+    """Yield the items in `collection`, most recently added first.
 
-    zot = zotero.Zotero(user_id, library_type, api_key=key)
-    zot.add_parameters(
+    Pages are requested one at a time, and no further pages are requested
+    once an item added more than `days` ago is seen, since every item after
+    it is older still.
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    pages = zot.pages('collections/{}/items'.format(collection),
+                concurrency=concurrency,
                 include='bib,data',
                 style='chicago-author-date',
                 linkwrap='0',
                 sort='dateAdded',
                 direction='desc'
             )
-    try:
-        items = zot.everything(zot.collection_items(collection))
-    except HTTPError:
-        sys.exit('HTTP Error')
+    for page in pages:
+        for item in page:
+            if days:
+                dateAdded = datetime.datetime.fromisoformat(item['data']['dateAdded'].replace("Z", "+00:00"))
+                d = (now - dateAdded).total_seconds()
+                delta = 86400*int(days)
+                if d > delta:
+                    return
+            yield item
 
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
-    for item in items:
-        if item['data'].get('itemType', '') in ('note', 'attachment'):
-            continue
-        if days:
-            dateAdded = datetime.datetime.fromisoformat(item['data']['dateAdded'].replace("Z", "+00:00"))
-            d = (now - dateAdded).total_seconds()
-            delta = 86400*int(days)
-            if d > delta:
+
+def bibliography(user_id=None, key=None, library_type='group', collection=None,
+                days=None, cache=zoteroapi.DEFAULT_CACHE, cache_size=100,
+                cache_ttl=24, stats=None, concurrency=1, **kwargs):
+    """Generate a wikitext bibliography via the Zotero API."""
+
+    out = []
+
+    zot = zoteroapi.Zotero(user_id, library_type, api_key=key, cache=cache,
+                cache_size=cache_size, cache_ttl=cache_ttl)
+    try:
+        for item in recent_items(zot, collection, days, concurrency):
+            if item['data'].get('itemType', '') in ('note', 'attachment'):
                 continue
-        out.append(_process_zotero_item(zot, item))
+            out.append(_process_zotero_item(zot, item))
+    except requests.HTTPError:
+        sys.exit('HTTP Error')
+    if stats:
+        print(zot.cache_summary())
     return '\n'.join(out)
 
 
@@ -0,0 +1,214 @@
+# Copyright 2022 Eric Thrift
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""zoteroapi
+
+Small client for the Zotero web API (version 3), shared by the Zotero
+scripts. Unlike pyzotero, it gives access to the response headers and status
+codes that incremental syncing relies on (Last-Modified-Version,
+If-Modified-Since-Version and 304 responses).
+
+Responses can be kept in an on-disk cache (see lrucache). Cached library
+data is always revalidated with a conditional request, so an unchanged
+response costs a 304 instead of a full download. Data that is not specific to
+a library (e.g., the item types) rarely changes, and is served from the cache
+without a request for `cache_ttl` hours.
+
+Large result sets can be fetched with several requests in flight at once
+(`concurrency`); the client pauses all requests when Zotero asks it to with a
+Backoff or Retry-After header.
+
+This is a helper module, not a script.
+"""
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import lrucache
+
+API_URL = 'https://api.zotero.org'
+
+DEFAULT_CACHE = os.path.expanduser(os.path.join('~', '.zotero_cache.sqlite'))
+
+# response headers kept with cached responses
+CACHED_HEADERS = ('Content-Type', 'Link', 'Last-Modified-Version',
+                  'Total-Results', 'ETag')
+
+# times to retry a request that Zotero answers with Retry-After
+MAX_RETRIES = 5
+
+
+class Zotero:
+    """A Zotero user or group library.
+
+    `cache` is the path of the response cache (no cache if empty),
+    `cache_size` its maximum size in MB, and `cache_ttl` the number of hours
+    for which data that does not belong to the library is not revalidated.
+    """
+
+    def __init__(self, library_id, library_type='group', api_key=None,
+            cache=None, cache_size=100, cache_ttl=24):
+        self.prefix = '/{}s/{}'.format(library_type, library_id)
+        self.session = requests.Session()
+        self.session.headers['Zotero-API-Version'] = '3'
+        if api_key:
+            self.session.headers['Zotero-API-Key'] = api_key
+        self.cache = None
+        if cache:
+            self.cache = lrucache.LRUCache(cache,
+                max_size=int(cache_size) * lrucache.MB)
+        self.ttl = float(cache_ttl) * 3600
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.backoff_until = 0
+
+    def url(self, path):
+        """Return the URL for `path`, relative to the library unless it
+        starts with a slash (e.g., '/itemTypes')."""
+        if path.startswith('/'):
+            return API_URL + path
+        return '{}{}/{}'.format(API_URL, self.prefix, path)
+
+    def _backoff(self, seconds):
+        """Hold back all requests for `seconds`, as asked by the server."""
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = 60
+        with self.lock:
+            self.backoff_until = max(self.backoff_until, time.time() + seconds)
+
+    def _get(self, url, headers=None, params=None):
+        for attempt in range(MAX_RETRIES + 1):
+            delay = self.backoff_until - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            r = self.session.get(url, params=params, headers=headers)
+            if r.headers.get('Backoff'):
+                self._backoff(r.headers['Backoff'])
+            if r.status_code in (429, 503) and r.headers.get('Retry-After'):
+                self._backoff(r.headers['Retry-After'])
+                if attempt < MAX_RETRIES:
+                    continue
+            break
+        if r.status_code != 304:
+            r.raise_for_status()
+        return r
+
+    def get(self, url, headers=None, **params):
+        """GET `url`; a 304 response is returned rather than raised.
+
+        Requests that set their own `headers` (e.g., a conditional request)
+        bypass the cache.
+        """
+        if self.cache is None or headers:
+            return self._get(url, headers, params)
+
+        key = requests.Request('GET', url, params=params).prepare().url
+        stable = not url.startswith(API_URL + self.prefix + '/')
+        cached = self.cache.get(key)
+        conditional = {}
+        if cached:
+            body, meta, age = cached
+            if stable and age < self.ttl:
+                self._count('hits')
+                return self._response(key, body, meta)
+            if meta.get('ETag'):
+                conditional['If-None-Match'] = meta['ETag']
+            if meta.get('Last-Modified-Version') and not stable:
+                conditional['If-Modified-Since-Version'] = \
+                    meta['Last-Modified-Version']
+
+        if conditional:
+            r = self._get(key, conditional)
+            if r.status_code == 304:
+                self._count('hits', 'revalidated')
+                self.cache.refresh(key)
+                return self._response(key, body, meta)
+        else:
+            r = self._get(key)
+        self._count('misses')
+        self.cache.set(key, r.content,
+            {h: r.headers[h] for h in CACHED_HEADERS if h in r.headers})
+        return r
+
+    def _count(self, *counters):
+        with self.lock:
+            self.stats.update(counters)
+
+    def _response(self, url, body, headers):
+        """Rebuild a response from the cache."""
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = body
+        r.headers.update(headers)
+        return r
+
+    def request(self, path, headers=None, **params):
+        return self.get(self.url(path), headers=headers, **params)
+
+    def pages(self, path, concurrency=1, **params):
+        """Yield the results at `path` one page at a time, in order.
+
+        With a `concurrency` above 1, the number of results given in the
+        first response is used to request up to `concurrency` further pages
+        at once. Pages are only requested a few ahead of the caller, so a
+        caller that stops early saves the remaining requests.
+        """
+        params.setdefault('limit', 100)
+        r = self.request(path, **params)
+        yield r.json()
+        total = int(r.headers.get('Total-Results', 0))
+        concurrency = int(concurrency)
+        if concurrency < 2 or not total:
+            while 'next' in r.links:
+                r = self.get(r.links['next']['url'])
+                yield r.json()
+            return
+
+        limit = int(params['limit'])
+        start = int(params.get('start', 0))
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = collections.deque()
+        try:
+            for offset in range(start + limit, total, limit):
+                pending.append(executor.submit(self.request, path,
+                    **dict(params, start=offset)))
+                if len(pending) >= concurrency:
+                    yield pending.popleft().result().json()
+            while pending:
+                yield pending.popleft().result().json()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def everything(self, path, concurrency=1, **params):
+        """Return all the results at `path`."""
+        return [i for page in self.pages(path, concurrency, **params)
+                for i in page]
+
+    def cache_summary(self):
+        """Return a one-line summary of the cache counters."""
+        return 'cache: {} hit(s) ({} revalidated), {} miss(es)'.format(
+            self.stats['hits'], self.stats['revalidated'],
+            self.stats['misses'])